@@ -0,0 +1,83 @@
+import bisect
+import database
+import perf
+
+class AutocompleteIndex:
+    """
+    Sorted in-memory index over the distinct values of one column.
+    Matches are ranked: whole value starts with the text, then a later word
+    starts with it, then the text appears anywhere. Comparison ignores case
+    and accents ("garcia" finds "García Márquez").
+    """
+    def __init__(self, values):
+        self.values = [str(v) for v in values]
+        self.prefixes = sorted((database.normalize_text(v), i) for i, v in enumerate(self.values))
+        # One entry per word after the first: "gabriel garcia marquez" -> "garcia marquez", "marquez"
+        self.word_prefixes = []
+        for key, i in self.prefixes:
+            pos = key.find(" ")
+            while pos != -1:
+                self.word_prefixes.append((key[pos + 1:], i))
+                pos = key.find(" ", pos + 1)
+        self.word_prefixes.sort()
+        # All keys in one string: str.find() scans it at C speed for the "anywhere" matches
+        self.blob = "\n".join(key for key, _ in self.prefixes)
+        self.offsets = []
+        pos = 0
+        for key, _ in self.prefixes:
+            self.offsets.append(pos)
+            pos += len(key) + 1
+
+    @staticmethod
+    def _starting_with(keys, text):
+        for pos in range(bisect.bisect_left(keys, (text,)), len(keys)):
+            key, i = keys[pos]
+            if not key.startswith(text):
+                break
+            yield i
+
+    def _containing(self, text):
+        pos = self.blob.find(text)
+        while pos != -1:
+            row = bisect.bisect_right(self.offsets, pos) - 1
+            yield self.prefixes[row][1]
+            next_row = row + 1
+            if next_row == len(self.offsets):
+                break
+            pos = self.blob.find(text, self.offsets[next_row])
+
+    @perf.timed("autocomplete.lookup", rows=len)
+    def lookup(self, text, limit=5):
+        text = database.normalize_text(text)
+        if not text:
+            return []
+        found = []
+        seen = set()
+        candidates = (
+            self._starting_with(self.prefixes, text),
+            self._starting_with(self.word_prefixes, text),
+            self._containing(text),
+        )
+        for source in candidates:
+            for i in source:
+                if i not in seen:
+                    seen.add(i)
+                    found.append(self.values[i])
+                    if len(found) == limit:
+                        return found
+        return found
+
+_indexes = {} # column -> (database.data_version(), AutocompleteIndex)
+
+def get_suggestions(column_name, text, limit=5):
+    """Top matches for text among the values already used in column_name."""
+    version = database.data_version()
+    cached = _indexes.get(column_name)
+    if cached is None or cached[0] != version:
+        with perf.measure("autocomplete.build_index"):
+            cached = (version, AutocompleteIndex(database.get_unique_values(column_name)))
+        _indexes[column_name] = cached
+    return cached[1].lookup(text, limit)
+
+def invalidate():
+    _indexes.clear()
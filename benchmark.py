@@ -0,0 +1,266 @@
+"""
+Headless benchmark for database.py, import_script.py and exporter.py.
+
+Generates reproducible synthetic catalogs, times the main operations against a
+throw-away database and prints (or saves) the results as JSON, so that two runs
+can be compared:
+
+    python benchmark.py --sizes 10000 100000 --output before.json
+    python benchmark.py --sizes 10000 100000 --compare before.json
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+SEED = 42
+
+TITLE_WORDS = [
+    "amore", "notte", "giorno", "storia", "mare", "città", "viaggio", "segreto", "ombra", "luce",
+    "tempo", "guerra", "pace", "casa", "giardino", "lettera", "strada", "isola", "fiume", "cuore",
+    "silenzio", "memoria", "sogno", "vento", "fuoco", "inverno", "estate", "perché", "libertà", "verità",
+]
+FIRST_NAMES = ["Marco", "Giulia", "Luca", "Francesca", "Alessandro", "Chiara", "Giovanni", "Elena",
+               "Paolo", "Sara", "Andrea", "Laura", "Nicolò", "Beatrice", "Umberto", "Italo", "Natalia"]
+LAST_NAMES = ["Rossi", "Bianchi", "Esposito", "Romano", "Colombo", "Ricci", "Marino", "Greco", "Bruno",
+              "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Eco", "Calvino", "Ginzburg"]
+GENRES = ["Romanzo", "Giallo", "Saggio", "Fantasy", "Fantascienza", "Storia", "Poesia", "Biografia",
+          "Ragazzi", "Cucina", "Arte", "Viaggi", "Filosofia", "Scienza", "Fumetti"]
+PUBLISHERS = ["Mondadori", "Einaudi", "Feltrinelli", "Adelphi", "Rizzoli", "Garzanti", "Bompiani",
+              "Sellerio", "Laterza", "Il Mulino", "Marsilio", "Neri Pozza", "Guanda", "Salani", "Fazi"]
+LANGUAGES = ["Italiano"] * 85 + ["Inglese"] * 10 + ["Francese"] * 3 + ["Tedesco"] * 2
+
+def _zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+def generate_catalog(size, seed=SEED):
+    """
+    Yields `size` book tuples in add_books() format. Authors, publishers and genres
+    follow a Zipf-like distribution: a few very common values and a long tail.
+    """
+    rng = random.Random(seed)
+    # Vocabulary grows with the catalog, roughly one author every 8 books
+    authors = [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}" for i in range(max(50, size // 8))]
+    author_weights = _zipf_weights(len(authors))
+    genre_weights = _zipf_weights(len(GENRES), 0.8)
+    publisher_weights = _zipf_weights(len(PUBLISHERS), 0.9)
+    batch = 10000
+    for start in range(0, size, batch):
+        count = min(batch, size - start)
+        picked_authors = rng.choices(authors, author_weights, k=count)
+        picked_genres = rng.choices(GENRES, genre_weights, k=count)
+        picked_publishers = rng.choices(PUBLISHERS, publisher_weights, k=count)
+        for i in range(count):
+            words = rng.sample(TITLE_WORDS, rng.randint(1, 4))
+            title = " ".join(words).capitalize() + (f" {start + i}" if rng.random() < 0.3 else "")
+            year = min(2025, max(1800, int(rng.gauss(1995, 25))))
+            location = f"{rng.choice('ABCDEFGH')}{rng.randint(1, 12)}"
+            yield (title, picked_authors[i], picked_genres[i], year, picked_publishers[i],
+                   location, rng.choice(LANGUAGES), 0)
+
+def write_catalog_csv(path, size, seed=SEED):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Titolo", "Autore", "Genere", "Anno", "Editore", "Posizione"])
+        for book in generate_catalog(size, seed):
+            writer.writerow(book[:6])
+
+def measure(operation, size, fn, repeat=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    result = {
+        "size": size,
+        "operation": operation,
+        "runs": repeat,
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+    }
+    print(f"  {operation:<32} median {result['median_ms']:>10.3f} ms", file=sys.stderr)
+    return result
+
+def run_size(size, workdir, repeat, seed=SEED):
+    import database
+    import autocomplete
+    import exporter
+    import import_script
+
+    print(f"Catalogo da {size} libri", file=sys.stderr)
+    results = []
+    rng = random.Random(seed)
+    database.configure(db_name=os.path.join(workdir, f"bench_{size}.db"))
+    database.create_table()
+
+    # --- Bulk load (also the baseline every other measurement runs on)
+    start = time.perf_counter()
+    chunk = []
+    for book in generate_catalog(size, seed):
+        chunk.append(book)
+        if len(chunk) == 5000:
+            database.add_books(chunk)
+            chunk = []
+    if chunk:
+        database.add_books(chunk)
+    elapsed = (time.perf_counter() - start) * 1000
+    results.append({"size": size, "operation": "add_books_bulk", "runs": 1, "min_ms": round(elapsed, 3),
+                    "median_ms": round(elapsed, 3), "mean_ms": round(elapsed, 3), "p95_ms": round(elapsed, 3),
+                    "rows_per_sec": round(size / (elapsed / 1000))})
+    print(f"  {'add_books_bulk':<32} {elapsed:>17.1f} ms", file=sys.stderr)
+
+    # --- Reads (result cache cleared before each run, so SQLite is actually hit)
+    def uncached(fn):
+        return lambda: (database.clear_cache(), fn())
+
+    for query in ("amore", "ross", "mondadori notte", "perche"):
+        results.append(measure(f"search_books[{query}]", size,
+                               uncached(lambda q=query: database.search_books(q)), repeat))
+    for query in ("calvno", "mondadro notte", "perche"):
+        results.append(measure(f"fuzzy_search_books[{query}]", size,
+                               uncached(lambda q=query: database.fuzzy_search_books(q)), repeat))
+    results.append(measure("get_books_page[first]", size, uncached(lambda: database.get_books_page(limit=50)), repeat))
+    results.append(measure("get_books_page[first, cached]", size, lambda: database.get_books_page(limit=50), repeat))
+
+    def deep_paging():
+        cursor = None
+        for _ in range(20):
+            _, cursor = database.get_books_page(after=cursor, limit=50)
+    results.append(measure("get_books_page[20 pages]", size, uncached(deep_paging), repeat))
+
+    results.append(measure("get_facets", size, uncached(lambda: database.get_facets(limit=30)), repeat))
+    stacked = (("genre", GENRES[1]), ("language", "Inglese"))
+    results.append(measure("get_facets[2 filters]", size,
+                           uncached(lambda: database.get_facets(stacked, limit=30)), repeat))
+    results.append(measure("get_books_page[2 filters]", size,
+                           uncached(lambda: database.get_books_page(limit=50, filters=stacked)), repeat))
+
+    for column in ("author", "genre", "publisher", "location", "language"):
+        results.append(measure(f"get_unique_values[{column}]", size,
+                               uncached(lambda c=column: database.get_unique_values(c)), repeat))
+    autocomplete.invalidate()
+    results.append(measure("autocomplete[author]", size,
+                           lambda: autocomplete.get_suggestions("author", "ros"), repeat * 4))
+
+    # --- Writes
+    ids = [row[0] for row in database.get_db_connection().execute("SELECT id FROM books LIMIT 200")]
+    results.append(measure("toggle_loan_status", size,
+                           lambda: database.toggle_loan_status(rng.choice(ids), 0, "Marco"), repeat))
+    results.append(measure("add_book", size,
+                           lambda: database.add_book("Benchmark", "Autore", "Saggio", 2000, "Editore",
+                                                     "Z1", "Italiano"), repeat))
+    results.append(measure("update_books[200]", size,
+                           lambda: database.update_books(ids, {"location": rng.choice("ABC") + "9"}), repeat))
+    book = next(iter(database.get_books_page(limit=1)[0]))
+    results.append(measure("update_book", size,
+                           lambda: database.update_book(book.id, book.title, book.author, "Saggio",
+                                                        book.year, book.publisher, "Z2", "Italiano", 0),
+                           repeat))
+
+    # --- Export
+    export_path = os.path.join(workdir, "export.csv")
+    results.append(measure("export[csv]", size, lambda: exporter.export_books(export_path), 1, warmup=0))
+    try:
+        import openpyxl # noqa: F401
+        xlsx_path = os.path.join(workdir, "export.xlsx")
+        results.append(measure("export[xlsx]", size, lambda: exporter.export_books(xlsx_path), 1, warmup=0))
+    except ImportError:
+        print("  export[xlsx] saltato: openpyxl non installato", file=sys.stderr)
+
+    # Delta export: after a first full run only the changed books are written
+    delta_path = os.path.join(workdir, "delta.csv")
+    exporter.export_changes(delta_path, target="bench")
+
+    def delta_export():
+        database.update_books(ids, {"location": rng.choice("ABC") + "8"})
+        exporter.export_changes(delta_path, target="bench")
+    results.append(measure("update_books+export_changes[200]", size, delta_export, repeat))
+
+    # --- Import (fresh DB: first run inserts, second run finds everything unchanged)
+    csv_path = os.path.join(workdir, "catalog.csv")
+    write_catalog_csv(csv_path, size, seed)
+    database.configure(db_name=os.path.join(workdir, f"bench_{size}_import.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        quiet = lambda stats: None
+        results.append(measure("import_data[csv, new]", size,
+                               lambda: import_script.import_data(csv_path, progress=quiet), 1, warmup=0))
+        results.append(measure("import_data[csv, unchanged]", size,
+                               lambda: import_script.import_data(csv_path, progress=quiet), 1, warmup=0))
+
+    database.close_all_connections()
+    return results
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["size"], r["operation"]): r for r in json.load(f)["results"]}
+    print(f"\n{'size':>8}  {'operation':<32} {'before':>10} {'after':>10} {'ratio':>7}", file=sys.stderr)
+    for r in results:
+        old = baseline.get((r["size"], r["operation"]))
+        if old:
+            ratio = r["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+            print(f"{r['size']:>8}  {r['operation']:<32} {old['median_ms']:>10.2f} {r['median_ms']:>10.2f} "
+                  f"{ratio:>6.2f}x", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di database.py / import / export su cataloghi sintetici")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="dimensioni dei cataloghi (es. 10000 100000 1000000)")
+    parser.add_argument("--repeat", type=int, default=5, help="ripetizioni per misura")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", help="salva i risultati JSON in questo file (default: stdout)")
+    parser.add_argument("--compare", help="JSON di un run precedente da confrontare")
+    parser.add_argument("--keep", action="store_true", help="non cancellare i database generati")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix="library_bench_")
+    # Work inside the temp dir so nothing can touch the real library.db
+    os.chdir(workdir)
+    try:
+        results = []
+        for size in args.sizes:
+            results.extend(run_size(size, workdir, args.repeat, args.seed))
+    finally:
+        if args.keep:
+            print(f"Database in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if baseline:
+        compare(results, baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Concurrency test for database.py: several reader and writer processes work on the
+same throw-away database at once, like the app, import_script and a second instance
+would. Prints throughput and "database is locked" errors per role as JSON:
+
+    python concurrency_test.py --readers 4 --writers 2 --seconds 10
+    python concurrency_test.py --journal-mode DELETE    # e.g. to compare with WAL
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmark import generate_catalog, SEED
+
+READ_QUERIES = ["amore", "ross", "mondadori notte", "perche", "storia"]
+
+def _setup(db_name, journal_mode, busy_timeout):
+    import database
+    database.configure(db_name=db_name, busy_timeout=busy_timeout, journal_mode=journal_mode)
+    return database
+
+def _reader_step(database, rng):
+    database.clear_cache() # Every call must really hit the file
+    choice = rng.random()
+    if choice < 0.4:
+        database.get_books_page(rng.choice(READ_QUERIES), limit=50)
+    elif choice < 0.7:
+        database.get_books_page(limit=50)
+    elif choice < 0.9:
+        database.get_facets(limit=30)
+    else:
+        database.count_books()
+
+def _writer_step(database, rng, ids):
+    choice = rng.random()
+    if choice < 0.4:
+        database.toggle_loan_status(rng.choice(ids), rng.randint(0, 1), "Test")
+    elif choice < 0.7:
+        database.add_book(f"Concorrenza {rng.randrange(10 ** 9)}", "Autore Test", "Saggio", 2000,
+                          "Editore", "Z1", "Italiano")
+    elif choice < 0.9:
+        database.update_books(rng.sample(ids, 20), {"location": f"Z{rng.randint(1, 9)}"})
+    else:
+        database.upsert_books([book for book in generate_catalog(50, rng.randrange(10 ** 6))])
+
+def worker(role, number, db_name, journal_mode, busy_timeout, start_at, seconds, results):
+    database = _setup(db_name, journal_mode, busy_timeout)
+    rng = random.Random(f"{role}{number}")
+    ids = [row[0] for row in database.get_db_connection().execute("SELECT id FROM books LIMIT 1000")]
+    timings = []
+    errors = {"locked": 0, "other": 0}
+    time.sleep(max(0, start_at - time.time()))
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            if role == "reader":
+                _reader_step(database, rng)
+            else:
+                _writer_step(database, rng, ids)
+        except sqlite3.OperationalError as e:
+            errors["locked" if "locked" in str(e) or "busy" in str(e) else "other"] += 1
+            continue
+        except sqlite3.Error:
+            errors["other"] += 1
+            continue
+        timings.append((time.perf_counter() - start) * 1000)
+    busy = database.busy_stats()
+    database.close_all_connections()
+    results.put({"role": role, "timings": timings, "errors": errors, "retries": busy["retries"]})
+
+def summarize(role, reports, seconds):
+    timings = sorted(t for r in reports for t in r["timings"])
+    summary = {
+        "processes": len(reports),
+        "ops": len(timings),
+        "ops_per_sec": round(len(timings) / seconds, 1),
+        "locked_errors": sum(r["errors"]["locked"] for r in reports),
+        "other_errors": sum(r["errors"]["other"] for r in reports),
+        "retries": sum(r["retries"] for r in reports),
+    }
+    if timings:
+        summary["median_ms"] = round(statistics.median(timings), 3)
+        summary["p95_ms"] = round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3)
+        summary["max_ms"] = round(timings[-1], 3)
+    print(f"  {role:<8} {summary['ops_per_sec']:>9.1f} op/s, {summary['locked_errors']} locked, "
+          f"{summary['retries']} retry", file=sys.stderr)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Lettori e scrittori concorrenti sullo stesso database")
+    parser.add_argument("--readers", type=int, default=4, help="processi che leggono")
+    parser.add_argument("--writers", type=int, default=2, help="processi che scrivono")
+    parser.add_argument("--seconds", type=float, default=10, help="durata della prova")
+    parser.add_argument("--size", type=int, default=20000, help="libri nel catalogo di partenza")
+    parser.add_argument("--journal-mode", default="WAL", help="WAL (default) o DELETE")
+    parser.add_argument("--busy-timeout", type=float, default=None, help="secondi (default: database.BUSY_TIMEOUT)")
+    parser.add_argument("--output", help="salva i risultati JSON in questo file (default: stdout)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="library_concurrency_")
+    db_name = os.path.join(workdir, "concurrency.db")
+    try:
+        database = _setup(db_name, args.journal_mode, args.busy_timeout)
+        database.create_table()
+        books = list(generate_catalog(args.size, SEED))
+        for i in range(0, len(books), 5000):
+            database.add_books(books[i:i + 5000])
+        database.close_all_connections()
+
+        print(f"{args.readers} lettori, {args.writers} scrittori, {args.journal_mode}, {args.seconds}s",
+              file=sys.stderr)
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1 # Gives every process time to start and open the file
+        processes = [multiprocessing.Process(target=worker, args=(role, n, db_name, args.journal_mode,
+                                                                  args.busy_timeout, start_at, args.seconds, results))
+                     for role, count in (("reader", args.readers), ("writer", args.writers))
+                     for n in range(count)]
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sqlite": sqlite3.sqlite_version,
+            "journal_mode": args.journal_mode,
+            "busy_timeout": database.BUSY_TIMEOUT,
+            "seconds": args.seconds,
+            "size": args.size,
+        },
+        "results": {role: summarize(role, [r for r in reports if r["role"] == role], args.seconds)
+                    for role in ("reader", "writer")},
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
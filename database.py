@@ -1,17 +1,408 @@
 import sqlite3
 import os
+import threading
+import time
+import contextlib
+import functools
+import perf
+import re
+import unicodedata
+from collections import OrderedDict
 
 DB_NAME = "library.db"
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+# Applied to every new connection (None = leave SQLite's default). Change them with configure().
+PRAGMAS = {
+    # WAL: readers and the writer don't block each other, so the app, import_script and
+    # other instances can work on the same file. It needs shared memory, which network
+    # shares don't reliably provide: there set LIBRARY_JOURNAL_MODE=DELETE
+    "journal_mode": os.environ.get("LIBRARY_JOURNAL_MODE", "WAL"),
+    "synchronous": "NORMAL",       # Safe with WAL: a power cut can only lose the last commits
+    "cache_size": -16000,          # negative = KiB, so ~16 MB of page cache per connection
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+BUSY_TIMEOUT = 10.0 # Seconds a connection waits for another process's lock before failing
+BUSY_RETRIES = 3 # Extra attempts of a write that still got "database is locked"
+
+# One persistent connection per thread, so the page cache survives between calls
+_local = threading.local()
+_open_connections = []
+_connections_lock = threading.Lock()
+_generation = 0 # Bumped by close_all_connections() to make threads reconnect
+
+def _open_connection():
+    # check_same_thread=False only so close_all_connections() can close it from the main thread
+    conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS.items():
+        if value is None:
+            continue
+        try:
+            conn.execute(f'PRAGMA {name} = {value}')
+        except sqlite3.OperationalError:
+            # Switching journal mode needs the file to itself; it is stored in the file,
+            # so one of the next connections will manage it
+            if name != "journal_mode":
+                raise
     return conn
 
-def create_table():
+def get_db_connection():
+    """Returns this thread's connection, opening it on first use. Do not close it."""
+    if getattr(_local, "generation", None) != _generation:
+        conn = _open_connection()
+        with _connections_lock:
+            _open_connections.append(conn)
+        _local.conn = conn
+        _local.generation = _generation
+        _local.data_version = None
+        _local.fts5 = None # See fts_enabled()
+        _local.fts_ready = False
+    return _local.conn
+
+def close_all_connections():
+    """Shutdown hook: closes the connections of every thread."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        while _open_connections:
+            conn = _open_connections.pop()
+            try:
+                # Refreshes planner statistics where queries need them (e.g. which filter index to use)
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+def close_connection():
+    """Closes this thread's connection, for short-lived threads (e.g. an export); reopened on next use."""
+    if getattr(_local, "generation", None) != _generation:
+        return # Never opened, or already closed by close_all_connections()
+    conn = _local.conn
+    _local.generation = None
+    with _connections_lock:
+        if conn in _open_connections:
+            _open_connections.remove(conn)
+    try:
+        conn.execute('PRAGMA optimize')
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def configure(db_name=None, busy_timeout=None, **pragmas):
+    """Switches database file, BUSY_TIMEOUT and/or PRAGMAs; takes effect on the next get_db_connection()."""
+    global DB_NAME, BUSY_TIMEOUT
+    if db_name is not None:
+        DB_NAME = db_name
+    if busy_timeout is not None:
+        BUSY_TIMEOUT = busy_timeout
+    PRAGMAS.update(pragmas)
+    close_all_connections()
+    _mark_written() # Different file: nothing cached is valid any more
+
+_busy_stats = {"retries": 0, "failures": 0}
+
+def _is_busy(error):
+    code = getattr(error, "sqlite_errorcode", None) # Python 3.11+
+    if code is None:
+        return "locked" in str(error) or "busy" in str(error)
+    return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) # Also the extended codes
+
+def retry_busy(fn):
+    """
+    Retries a write function that failed with "database is locked". The busy timeout
+    already waits for most locks; this covers the cases where SQLite gives up at once
+    (e.g. a WAL snapshot that went stale). The failed transaction was rolled back, so
+    running the whole function again is safe, as long as its arguments can be read twice
+    (lists, not generators).
+    """
+    timed_fn = perf.timed(f"db.{fn.__name__}")(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return timed_fn(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e):
+                    raise
+                if attempt == BUSY_RETRIES:
+                    _busy_stats["failures"] += 1
+                    raise
+                _busy_stats["retries"] += 1
+                perf.count("db.busy_retry")
+                time.sleep(0.05 * 2 ** attempt)
+    return wrapper
+
+def busy_stats():
+    """How many writes were retried, and how many still failed, because of locks."""
+    return dict(_busy_stats)
+
+@contextlib.contextmanager
+def write_transaction():
+    """
+    Transaction for a write: takes the write lock up front (BEGIN IMMEDIATE), so waiting
+    for another writer happens before any work is done, never half-way through it.
+    Keep it short: other processes wait for it. Commits on success, rolls back on error.
+    """
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+
+def _in_batches(values, size=500):
+    """
+    Yields (placeholders, batch) for each slice of values, for 'IN ({placeholders})'
+    queries that stay below old SQLite's 999 variables limit.
+    """
+    values = list(values)
+    for i in range(0, len(values), size):
+        batch = values[i:i + size]
+        yield ",".join("?" * len(batch)), batch
+
+_write_count = 0 # Bumped by every write function, see data_version()
+_external_changes = 0 # Commits noticed through PRAGMA data_version
+_version_lock = threading.Lock()
+
+def _mark_written():
+    global _write_count
+    with _version_lock:
+        _write_count += 1
+
+def data_version():
+    """
+    Token that changes whenever books are written, by this process or by another
+    one (e.g. import_script), so in-memory caches know when to rebuild.
+    """
+    global _external_changes
+    conn = get_db_connection()
+    # PRAGMA data_version is per connection and only moves when *another* connection commits.
+    # A new connection has no baseline: it can't tell what was committed before it opened,
+    # so its first look counts as a change too.
+    current = conn.execute('PRAGMA data_version').fetchone()[0]
+    with _version_lock:
+        if current != _local.data_version:
+            _external_changes += 1
+        _local.data_version = current
+        return (_write_count, _external_changes)
+
+# --- Result cache for the read functions ---
+
+CACHE_MAX_ROWS = 20000 # Upper bound on cached rows/values across all entries
+
+_cache = OrderedDict() # key -> (cost in rows, result), least recently used first
+_cache_rows = 0
+_cache_version = None
+_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+_cache_lock = threading.Lock()
+
+def _copy_result(result):
+    # Callers get their own lists, so the cached ones can't be modified.
+    # The Book objects inside are shared: copy() one before changing it.
+    if isinstance(result, list):
+        return list(result)
+    if isinstance(result, dict):
+        return {key: _copy_result(value) for key, value in result.items()}
+    if isinstance(result, tuple):
+        return tuple(_copy_result(r) for r in result)
+    return result
+
+def _result_cost(result):
+    """Rows/values held by a result (at least 1)."""
+    if isinstance(result, list):
+        return max(1, len(result))
+    if isinstance(result, dict):
+        return sum(_result_cost(value) for value in result.values()) or 1
+    if isinstance(result, tuple):
+        return sum(_result_cost(r) for r in result)
+    return 1
+
+def cached_read(fn):
+    """
+    LRU cache for read functions, bounded by CACHE_MAX_ROWS. Everything is dropped
+    as soon as data_version() changes, i.e. after any write to the books.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _cache_rows, _cache_version
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        version = data_version()
+        with _cache_lock:
+            if version != _cache_version:
+                if _cache:
+                    _cache_stats["invalidations"] += 1
+                _cache.clear()
+                _cache_rows = 0
+                _cache_version = version
+            entry = _cache.get(key)
+            if entry is not None:
+                _cache.move_to_end(key)
+                _cache_stats["hits"] += 1
+                perf.count("cache.hit")
+                return _copy_result(entry[1])
+            _cache_stats["misses"] += 1
+        perf.count("cache.miss")
+
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+
+        cost = _result_cost(result)
+        perf.record(f"db.{fn.__name__}", (time.perf_counter() - start) * 1000, cost)
+        with _cache_lock:
+            if version == _cache_version and cost <= CACHE_MAX_ROWS:
+                if key in _cache: # Another thread got here first
+                    _cache_rows -= _cache.pop(key)[0]
+                _cache[key] = (cost, result)
+                _cache_rows += cost
+                while _cache_rows > CACHE_MAX_ROWS:
+                    _, (old_cost, _) = _cache.popitem(last=False)
+                    _cache_rows -= old_cost
+                    _cache_stats["evictions"] += 1
+        return _copy_result(result)
+    return wrapper
+
+def cache_stats():
+    """Hit/miss counters of the result cache, plus its current size."""
+    with _cache_lock:
+        return dict(_cache_stats, entries=len(_cache), rows=_cache_rows)
+
+def clear_cache():
+    global _cache_rows
+    with _cache_lock:
+        _cache.clear()
+        _cache_rows = 0
+
+# Columns of a Book, in SELECT order (book_key is internal and stays in the DB)
+BOOK_FIELDS = ('id', 'title', 'author', 'genre', 'year', 'publisher', 'location', 'language',
+               'is_loaned', 'loaned_to')
+BOOK_COLUMNS = ", ".join(BOOK_FIELDS)
+
+class Book:
+    """
+    One row of the books table. __slots__ keeps it to a few pointers per book, much less
+    than a sqlite3.Row or a dict; book['title'] still works for code that indexes by name.
+    """
+    __slots__ = BOOK_FIELDS
+
+    def __init__(self, id=None, title=None, author=None, genre=None, year=None, publisher=None,
+                 location=None, language=None, is_loaned=0, loaned_to=None):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.genre = genre
+        self.year = year
+        self.publisher = publisher
+        self.location = location
+        self.language = language
+        self.is_loaned = is_loaned
+        self.loaned_to = loaned_to
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        return isinstance(other, Book) and self.astuple() == other.astuple()
+
+    def __repr__(self):
+        return f"Book(id={self.id!r}, title={self.title!r}, author={self.author!r})"
+
+    def astuple(self):
+        return tuple(getattr(self, f) for f in BOOK_FIELDS)
+
+    def as_dict(self):
+        return {f: getattr(self, f) for f in BOOK_FIELDS}
+
+    def copy(self):
+        return Book(*self.astuple())
+
+def book_factory(cursor, row):
+    """Row factory for queries selecting BOOK_COLUMNS."""
+    return Book(*row)
+
+def _fetch(sql, params=(), row_factory=None):
+    """Runs a query on this thread's connection with its own row factory (None: plain tuples)."""
+    cursor = get_db_connection().cursor()
+    cursor.row_factory = row_factory
+    return cursor.execute(sql, params)
+
+def normalize_text(value):
+    """Lowercase, accent-free, single-spaced form of a value, for matching ("Perché" -> "perche")."""
+    if value is None:
+        return ""
+    text = str(value)
+    if text.isascii(): # Nothing to fold: the common case, and much faster
+        return " ".join(text.lower().split())
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return " ".join("".join(ch for ch in text if not unicodedata.combining(ch)).split())
+
+def _normalize_year(year):
+    """1998, 1998.0 and "1998" are the same year."""
+    try:
+        number = float(year)
+    except (TypeError, ValueError):
+        return year
+    return int(number) if number.is_integer() else year
+
+def book_key(title, author, year, publisher):
+    """Natural key of a book: title+author+year+publisher, ignoring case, accents and spacing."""
+    year = _normalize_year(year)
+    return "\x1f".join(normalize_text(v) for v in (title, author, year, publisher))
+
+def _backfill_book_keys(conn):
+    seen = set()
+    updates = []
+    for row in conn.execute('SELECT id, title, author, year, publisher FROM books ORDER BY id'):
+        key = book_key(row['title'], row['author'], row['year'], row['publisher'])
+        if key not in seen: # Later duplicates keep a NULL key
+            seen.add(key)
+            updates.append((key, row['id']))
+    conn.executemany('UPDATE books SET book_key = ? WHERE id = ?', updates)
+
+def _hand_over_keys(conn, keys=None):
+    """
+    Gives the book_key of a deleted or changed book to a remaining copy of it (the oldest
+    row with a NULL key and the same book_key()), so that imports still find the book.
+    keys: the keys that may have lost their holder; None checks every copy.
+    """
+    if keys is not None:
+        keys = {key for key in keys if key}
+        if not keys:
+            return
+    candidates = {}
+    # Only the copies have a NULL key: idx_books_unkeyed keeps this short
+    for book_id, *fields in conn.execute(
+            'SELECT id, title, author, year, publisher FROM books WHERE book_key IS NULL ORDER BY id').fetchall():
+        key = book_key(*fields)
+        if (keys is None or key in keys) and key not in candidates:
+            candidates[key] = book_id
+    held = set()
+    for placeholders, batch in _in_batches(candidates):
+        held.update(row[0] for row in conn.execute(
+            f'SELECT book_key FROM books WHERE book_key IN ({placeholders})', batch))
+    conn.executemany('UPDATE books SET book_key = ? WHERE id = ?',
+                     [(key, book_id) for key, book_id in candidates.items() if key not in held])
+
+def _book_keys(conn, book_ids):
+    return [row[1] for row in _rows_by_id(conn, book_ids, 'book_key')]
+
+@retry_busy
+def create_table():
+    """Creates or upgrades the schema (see MIGRATIONS), then the full-text index."""
+    migrate(get_db_connection())
+    with write_transaction() as conn:
+        create_search_index(conn) # Not a migration: depends on this PC's SQLite build
+
+def _add_column(conn, table, column, definition):
+    """Adds a column unless it exists; returns True if it was added."""
+    if any(row['name'] == column for row in conn.execute(f'PRAGMA table_info({table})')):
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def _migration_base_schema(conn):
+    # Also upgrades DBs created before migrations existed, hence IF NOT EXISTS/_add_column
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS books (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT,
@@ -22,76 +413,885 @@ def create_table():
             location TEXT,
             language TEXT,
             is_loaned INTEGER DEFAULT 0,
-            loaned_to TEXT
+            loaned_to TEXT,
+            book_key TEXT
+        )
+    ''')
+    _add_column(conn, 'books', 'loaned_to', 'TEXT')
+    if _add_column(conn, 'books', 'book_key', 'TEXT'):
+        _backfill_book_keys(conn)
+
+    # Keyset pagination order (see get_books_page)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_title ON books (title COLLATE NOCASE, id)')
+    # Natural key used by upsert_books(); NULL marks extra copies of the same book
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_books_key ON books (book_key) WHERE book_key IS NOT NULL')
+
+def _migration_filter_indexes(conn):
+    # Filters and DISTINCT lookups (autocomplete) on the metadata columns
+    for column in ('author', 'genre', 'location', 'language'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_books_{column} ON books ({column})')
+    # Only loaned books are indexed: "what is lent, and to whom" without scanning the shelf
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_loaned ON books (loaned_to COLLATE NOCASE) WHERE is_loaned = 1')
+
+def _migration_fuzzy_index(conn):
+    # Vocabulary and postings for fuzzy_search_books(); WITHOUT ROWID since the primary
+    # keys are the lookups, no extra index needed
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_words (
+            id INTEGER PRIMARY KEY,
+            word TEXT NOT NULL UNIQUE,
+            trigram_count INTEGER NOT NULL
         )
     ''')
-    # Migration for existing DBs
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_word_trigrams (
+            trigram TEXT NOT NULL,
+            word_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, word_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_word_books (
+            word_id INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            PRIMARY KEY (word_id, book_id)
+        ) WITHOUT ROWID
+    ''')
+    _index_books(conn, conn.execute('SELECT id, title, author, publisher FROM books'))
+
+# Columns with counts in facet_counts (see get_facets)
+FACETS = ('genre', 'author', 'location', 'language', 'is_loaned')
+
+# Adds delta to the counts of the values of a row (new or old) inside a trigger.
+# NULL and '' are both stored as '' ("no value")
+_FACET_COUNT_SQL = '''
+    INSERT INTO facet_counts (facet, value, count) VALUES
+        ('genre', COALESCE({row}.genre, ''), {delta}), ('author', COALESCE({row}.author, ''), {delta}),
+        ('location', COALESCE({row}.location, ''), {delta}), ('language', COALESCE({row}.language, ''), {delta}),
+        ('is_loaned', COALESCE({row}.is_loaned, ''), {delta})
+    ON CONFLICT (facet, value) DO UPDATE SET count = count + excluded.count;
+'''
+
+def _migration_facet_counts(conn):
+    # Book counts per facet value, kept current by triggers so browsing never has to
+    # GROUP BY the whole table. value has no type, so is_loaned stays an integer.
+    # Values that drop to 0 keep their row (readers skip them) to keep deletes cheap
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            facet TEXT NOT NULL,
+            value NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (facet, value)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS facet_counts_ai AFTER INSERT ON books BEGIN
+            {_FACET_COUNT_SQL.format(row='new', delta=1)}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS facet_counts_ad AFTER DELETE ON books BEGIN
+            {_FACET_COUNT_SQL.format(row='old', delta=-1)}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS facet_counts_au AFTER UPDATE OF genre, author, location, language, is_loaned ON books
+        WHEN old.genre IS NOT new.genre OR old.author IS NOT new.author OR old.location IS NOT new.location
+          OR old.language IS NOT new.language OR old.is_loaned IS NOT new.is_loaned
+        BEGIN
+            {_FACET_COUNT_SQL.format(row='old', delta=-1)}
+            {_FACET_COUNT_SQL.format(row='new', delta=1)}
+        END
+    ''')
+    _count_facets(conn)
+
+    # Filtered browsing: (column, title) indexes give the rows of one value already in
+    # list order, so a page never sorts every match. They also serve the old lookups
+    for column in ('author', 'genre', 'location', 'language'):
+        conn.execute(f'DROP INDEX IF EXISTS idx_books_{column}')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_books_{column}_title ON books ({column}, title COLLATE NOCASE, id)')
+
+def _count_facets(conn):
+    conn.execute('DELETE FROM facet_counts')
+    for facet in FACETS:
+        conn.execute(f'''
+            INSERT INTO facet_counts (facet, value, count)
+            SELECT '{facet}', COALESCE({facet}, ''), COUNT(*) FROM books GROUP BY 2
+        ''')
+
+def _migration_loans(conn):
+    # Loan history. books.is_loaned/loaned_to stay as the current state; triggers append a
+    # row here on every loan and fill returned_at on return, whichever function wrote it.
+    # Rows are never deleted or otherwise changed. Times are UTC, 'YYYY-MM-DD HH:MM:SS'
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loans (
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL,
+            borrower TEXT,
+            loaned_at TEXT NOT NULL,
+            returned_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_loans_book ON loans (book_id, loaned_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_loans_borrower ON loans (borrower COLLATE NOCASE, loaned_at)')
+    # Open loans only, oldest first: current and overdue loans without touching the history
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_loans_open ON loans (loaned_at) WHERE returned_at IS NULL')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS loans_ai AFTER INSERT ON books WHEN new.is_loaned = 1 BEGIN
+            INSERT INTO loans (book_id, borrower, loaned_at) VALUES (new.id, new.loaned_to, datetime('now'));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS loans_au AFTER UPDATE OF is_loaned, loaned_to ON books
+        WHEN old.is_loaned IS NOT new.is_loaned OR (new.is_loaned = 1 AND old.loaned_to IS NOT new.loaned_to)
+        BEGIN
+            UPDATE loans SET returned_at = datetime('now') WHERE book_id = old.id AND returned_at IS NULL;
+            INSERT INTO loans (book_id, borrower, loaned_at)
+            SELECT new.id, new.loaned_to, datetime('now') WHERE new.is_loaned = 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS loans_ad AFTER DELETE ON books WHEN old.is_loaned = 1 BEGIN
+            UPDATE loans SET returned_at = datetime('now') WHERE book_id = old.id AND returned_at IS NULL;
+        END
+    ''')
+    # Loans made before the history existed: their real date is unknown, so they start now
+    conn.execute('''
+        INSERT INTO loans (book_id, borrower, loaned_at)
+        SELECT id, loaned_to, datetime('now') FROM books WHERE is_loaned = 1
+    ''')
+
+# Logs a change of one book in book_changes: a new seq from the counter, and the seq of
+# its insertion when it is new (0 = the book was there before tracking began; MAX keeps
+# it when a later change of the same book passes 0)
+_CHANGE_SQL = '''
+    INSERT INTO book_changes (book_id, seq, inserted_seq, deleted, changed_at)
+    VALUES ({row}.id, (SELECT COALESCE(MAX(seq), 0) + 1 FROM book_changes),
+            {inserted}, {deleted}, datetime('now'))
+    ON CONFLICT (book_id) DO UPDATE SET
+        seq = excluded.seq, inserted_seq = MAX(inserted_seq, excluded.inserted_seq),
+        deleted = excluded.deleted, changed_at = excluded.changed_at;
+'''
+
+def _migration_change_log(conn):
+    # Last change of each book, kept by triggers whichever function wrote it, so that a
+    # delta export only reads the books changed after its watermark (idx_book_changes_seq).
+    # One row per book, not per change: the log never grows beyond the catalog plus deletions
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book_changes (
+            book_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            inserted_seq INTEGER NOT NULL,
+            deleted INTEGER NOT NULL,
+            changed_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_book_changes_seq ON book_changes (seq)')
+    # Where each delta export target stopped (see exporter.export_changes)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            target TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            exported_at TEXT NOT NULL
+        )
+    ''')
+    inserted = '(SELECT COALESCE(MAX(seq), 0) + 1 FROM book_changes)'
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_changes_ai AFTER INSERT ON books BEGIN
+            {_CHANGE_SQL.format(row='new', inserted=inserted, deleted=0)}
+        END
+    ''')
+    # book_key is internal, and saving a book without changes is not a change
+    columns = BOOK_FIELDS[1:]
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_changes_au AFTER UPDATE OF {", ".join(columns)} ON books
+        WHEN {" OR ".join(f"old.{c} IS NOT new.{c}" for c in columns)}
+        BEGIN
+            {_CHANGE_SQL.format(row='new', inserted=0, deleted=0)}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS book_changes_ad AFTER DELETE ON books BEGIN
+            {_CHANGE_SQL.format(row='old', inserted=0, deleted=1)}
+        END
+    ''')
+
+def _migration_unkeyed_index(conn):
+    # Copies of a book (NULL book_key) are few: indexing just them lets _hand_over_keys()
+    # find them without a scan. Then repairs the books that lost their key before that
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_unkeyed ON books (id) WHERE book_key IS NULL')
+    _hand_over_keys(conn)
+
+# Schema history: PRAGMA user_version is the number of migrations already applied.
+# Append new steps at the end, never edit or reorder applied ones.
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_filter_indexes,
+    _migration_fuzzy_index,
+    _migration_facet_counts,
+    _migration_loans,
+    _migration_change_log,
+    _migration_unkeyed_index,
+]
+
+def migrate(conn):
+    """Applies the pending MIGRATIONS, each exactly once and in its own transaction."""
+    while True:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        with conn:
+            # IMMEDIATE: two instances starting together must not both migrate
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] == version:
+                MIGRATIONS[version](conn)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+
+def _fts5_available(conn):
     try:
-        c.execute('ALTER TABLE books ADD COLUMN loaned_to TEXT')
+        conn.execute('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)')
+        conn.execute('DROP TABLE temp.fts5_probe')
+        return True
     except sqlite3.OperationalError:
-        pass # Column already exists
-    
-    conn.commit()
-    conn.close()
+        return False
 
-def add_book(title, author, genre, year, publisher, location, language, is_loaned=0, loaned_to=None):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO books (title, author, genre, year, publisher, location, language, is_loaned, loaned_to)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (title, author, genre, year, publisher, location, language, is_loaned, loaned_to))
-    conn.commit()
-    conn.close()
-
-def get_all_books(limit=50, offset=0):
+def fts_enabled():
+    """
+    True if searches can use books_fts on this thread's connection: its SQLite has FTS5
+    and the file has the index with its triggers (see create_search_index()). Checked
+    per connection, so processes that never call create_table() still use the index.
+    """
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title COLLATE NOCASE LIMIT ? OFFSET ?', (limit, offset)).fetchall()
-    conn.close()
-    return books
+    if _local.fts5 is None:
+        _local.fts5 = _fts5_available(conn)
+    if _local.fts5 and not _local.fts_ready: # Until another connection creates it
+        _local.fts_ready = conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'books_fts_%'"
+        ).fetchone()[0] == 3
+    return _local.fts_ready
+
+def create_search_index(conn):
+    """Creates the FTS5 index over title/author/genre/publisher, kept in sync by triggers."""
+    if not _fts5_available(conn):
+        # The DB may come from a PC with FTS5: drop the triggers so writes keep working here
+        for name in ('books_fts_ai', 'books_fts_ad', 'books_fts_au'):
+            conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        return
+
+    in_sync = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'books_fts_%'"
+    ).fetchone()[0] == 3
+
+    # External content table: the text lives only in books, FTS stores just the index
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, author, genre, publisher,
+            content='books', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, author, genre, publisher)
+            VALUES (new.id, new.title, new.author, new.genre, new.publisher);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, genre, publisher)
+            VALUES ('delete', old.id, old.title, old.author, old.genre, old.publisher);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author, genre, publisher ON books
+        WHEN old.title IS NOT new.title OR old.author IS NOT new.author
+          OR old.genre IS NOT new.genre OR old.publisher IS NOT new.publisher
+        BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, genre, publisher)
+            VALUES ('delete', old.id, old.title, old.author, old.genre, old.publisher);
+            INSERT INTO books_fts(rowid, title, author, genre, publisher)
+            VALUES (new.id, new.title, new.author, new.genre, new.publisher);
+        END
+    ''')
+
+    if not in_sync:
+        # New index, or rows were written by a build without FTS5: reindex everything
+        conn.execute("INSERT INTO books_fts(books_fts) VALUES('rebuild')")
+
+def build_fts_query(query):
+    """Turns free text into an FTS5 query: every word must match as a prefix."""
+    terms = []
+    for word in query.split():
+        if any(ch.isalnum() for ch in word):
+            terms.append('"' + word.replace('"', '""') + '"*')
+    return " ".join(terms)
+
+# --- Fuzzy search: trigram index over the words of title/author/publisher ---
+# search_words holds every normalized word once, search_word_trigrams maps trigrams to
+# those words and search_word_books words to books. Typos are resolved on the (small)
+# vocabulary first, then the books are found through the word postings.
+
+FUZZY_MIN_SIMILARITY = 0.4 # Average similarity of the query words a book must reach
+FUZZY_WORD_SIMILARITY = 0.4 # Trigram similarity for a word to count as a match
+FUZZY_MAX_WORD_MATCHES = 50 # Vocabulary words tried per query word
+
+_WORD_RE = re.compile(r"\w+")
+
+def _words(text):
+    return _WORD_RE.findall(normalize_text(text))
+
+def _book_words(title, author, publisher):
+    return set(_words(title)) | set(_words(author)) | set(_words(publisher))
+
+def word_trigrams(word):
+    """Trigrams of a normalized word padded as "  word " (pg_trgm style): "ab" -> "  a", " ab", "ab "."""
+    word = f"  {word} "
+    return {word[i:i + 3] for i in range(len(word) - 2)}
 
-def search_books(query, limit=50, offset=0):
+def _word_ids(conn, words, create=True):
+    """{word: id} from search_words; with create, missing words are added with their trigrams."""
+    words = list(words)
+    ids = {}
+    for placeholders, batch in _in_batches(words):
+        ids.update(conn.execute(f'SELECT word, id FROM search_words WHERE word IN ({placeholders})', batch).fetchall())
+    if create:
+        postings = []
+        for word in words:
+            if word not in ids:
+                grams = word_trigrams(word)
+                ids[word] = conn.execute('INSERT INTO search_words (word, trigram_count) VALUES (?, ?)',
+                                         (word, len(grams))).lastrowid
+                postings.extend((gram, ids[word]) for gram in grams)
+        conn.executemany('INSERT INTO search_word_trigrams (trigram, word_id) VALUES (?, ?)', sorted(postings))
+    return ids
+
+def _index_books(conn, rows):
+    """Adds (id, title, author, publisher) rows to the fuzzy index, inside the caller's transaction."""
+    books = [(row[0], _book_words(*row[1:])) for row in rows]
+    ids = _word_ids(conn, set().union(*(words for _, words in books)))
+    # In key order, so each posting list is appended to rather than hopping across the tree
+    conn.executemany('INSERT OR IGNORE INTO search_word_books (word_id, book_id) VALUES (?, ?)',
+                     sorted((ids[word], book_id) for book_id, words in books for word in words))
+
+def _unindex_books(conn, book_ids):
+    """Removes these books from the fuzzy index; call it before their row changes or goes away."""
+    for placeholders, batch in _in_batches(book_ids):
+        books = [(row[0], _book_words(*row[1:])) for row in conn.execute(
+            f'SELECT id, title, author, publisher FROM books WHERE id IN ({placeholders})', batch)]
+        ids = _word_ids(conn, set().union(*(words for _, words in books)), create=False)
+        conn.executemany('DELETE FROM search_word_books WHERE word_id = ? AND book_id = ?',
+                         ((ids[word], book_id) for book_id, words in books for word in words if word in ids))
+
+def _index_new_books(conn, last_id):
+    # AUTOINCREMENT ids only grow: everything above last_id was inserted by the caller
+    _index_books(conn, conn.execute('SELECT id, title, author, publisher FROM books WHERE id > ?', (last_id,)))
+
+def _last_book_id(conn):
+    return conn.execute('SELECT COALESCE(MAX(id), 0) FROM books').fetchone()[0]
+
+@retry_busy
+def rebuild_search_words():
+    """Recomputes the whole fuzzy index, e.g. after editing library.db with other tools."""
+    with write_transaction() as conn:
+        for table in ('search_word_books', 'search_word_trigrams', 'search_words'):
+            conn.execute(f'DELETE FROM {table}')
+        _index_books(conn, conn.execute('SELECT id, title, author, publisher FROM books'))
+    _mark_written()
+
+def _similar_words(conn, word):
+    """(word id, similarity) of the vocabulary words sharing enough trigrams with word."""
+    grams = list(word_trigrams(word))
+    return conn.execute(f'''
+        SELECT word_id, hits * 1.0 / (? + trigram_count - hits) AS similarity FROM (
+            SELECT word_id, COUNT(*) AS hits FROM search_word_trigrams
+            WHERE trigram IN ({",".join("?" * len(grams))})
+            GROUP BY word_id
+        ) JOIN search_words ON search_words.id = word_id
+        WHERE similarity >= ?
+        ORDER BY similarity DESC
+        LIMIT ?
+    ''', (len(grams), *grams, FUZZY_WORD_SIMILARITY, FUZZY_MAX_WORD_MATCHES)).fetchall()
+
+@cached_read
+def fuzzy_search_books(query, limit=50, min_similarity=FUZZY_MIN_SIMILARITY, filters=()):
+    """
+    Books whose title/author/publisher words look like the words of query, best match
+    first. Tolerates typos and missing accents ("Calvno", "perche"); there is no paging.
+    filters: as in get_books_page().
+    """
+    words = list(dict.fromkeys(_words(query)))
+    if not words:
+        return []
     conn = get_db_connection()
+    matches = [(qi, word_id, similarity) for qi, word in enumerate(words)
+               for word_id, similarity in _similar_words(conn, word)]
+    if not matches:
+        return []
+    where, filter_params = _filter_clause(filters)
+    # A book scores the best similarity it reaches for each query word, averaged
+    return _fetch(f'''
+        WITH matches (qi, word_id, similarity) AS (VALUES {",".join(["(?, ?, ?)"] * len(matches))})
+        SELECT {BOOK_COLUMNS} FROM (
+            SELECT book_id, SUM(best) AS score FROM (
+                SELECT book_id, qi, MAX(similarity) AS best
+                FROM matches JOIN search_word_books USING (word_id)
+                GROUP BY book_id, qi
+            ) GROUP BY book_id HAVING score >= ?
+        ) JOIN books ON books.id = book_id
+        WHERE {where}
+        ORDER BY score DESC, title COLLATE NOCASE, id
+        LIMIT ?
+    ''', (*(v for match in matches for v in match), min_similarity * len(words), *filter_params, limit),
+        row_factory=book_factory).fetchall()
+
+# book_key for a new row, or NULL when another row already has it (a second copy of the same book)
+_NEW_KEY_SQL = '(SELECT CASE WHEN EXISTS (SELECT 1 FROM books WHERE book_key = ?1) THEN NULL ELSE ?1 END)'
+
+@retry_busy
+def add_book(title, author, genre, year, publisher, location, language, is_loaned=0, loaned_to=None):
+    """Inserts one book; returns its id."""
+    key = book_key(title, author, year, publisher)
+    with write_transaction() as conn:
+        cursor = conn.execute(f'''
+            INSERT INTO books (title, author, genre, year, publisher, location, language, is_loaned, loaned_to, book_key)
+            VALUES (?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, {_NEW_KEY_SQL})
+        ''', (key, title, author, genre, year, publisher, location, language, is_loaned, loaned_to))
+        _index_books(conn, [(cursor.lastrowid, title, author, publisher)])
+    _mark_written()
+    return cursor.lastrowid
+
+@retry_busy
+def add_books(records):
+    """
+    Bulk insert in a single transaction, used by import_script.
+    records: (title, author, genre, year, publisher, location, language, is_loaned) tuples.
+    """
+    with write_transaction() as conn:
+        last_id = _last_book_id(conn)
+        conn.executemany(f'''
+            INSERT INTO books (title, author, genre, year, publisher, location, language, is_loaned, book_key)
+            VALUES (?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, {_NEW_KEY_SQL})
+        ''', ((book_key(r[0], r[1], r[3], r[4]), *r) for r in records))
+        _index_new_books(conn, last_id)
+    _mark_written()
+
+# Columns an import is allowed to overwrite; language and loan status are only edited in the app
+UPSERT_FIELDS = ('title', 'author', 'genre', 'year', 'publisher', 'location')
+
+@retry_busy
+def upsert_books(records):
+    """
+    Idempotent bulk import in a single transaction, matching books on book_key().
+    New books are inserted; existing ones are updated only if a non-empty imported
+    field differs. Returns {'inserted': n, 'updated': n, 'skipped': n}.
+    records: same tuples as add_books().
+    """
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    keyed = [(book_key(r[0], r[1], r[3], r[4]), r) for r in records]
+
+    # The lookups are in the write transaction too: another process can't insert
+    # one of these books between them and the INSERT
+    with write_transaction() as conn:
+        existing = {}
+        for placeholders, batch in _in_batches({key for key, _ in keyed}):
+            rows = conn.execute(
+                f'SELECT id, book_key, {", ".join(UPSERT_FIELDS)} FROM books WHERE book_key IN ({placeholders})',
+                batch).fetchall()
+            existing.update((row['book_key'], dict(row)) for row in rows)
+
+        inserts = {} # key -> record, in file order
+        updates = {} # id -> row with the new values
+        for key, record in keyed:
+            imported = dict(zip(UPSERT_FIELDS, record))
+            if key in inserts:
+                # Same book repeated in this batch: merge into the pending insert
+                inserts[key] = tuple(imported[f] if imported[f] is not None else old
+                                     for f, old in zip(UPSERT_FIELDS, inserts[key])) + inserts[key][len(UPSERT_FIELDS):]
+                stats['skipped'] += 1
+                continue
+            current = existing.get(key)
+            if current is None:
+                inserts[key] = tuple(record)
+                stats['inserted'] += 1
+                continue
+            changes = {f: v for f, v in imported.items()
+                       if v is not None and _normalize_year(v) != _normalize_year(current[f])}
+            if changes:
+                stats['updated' if current['id'] not in updates else 'skipped'] += 1
+                current.update(changes)
+                updates[current['id']] = current
+            else:
+                stats['skipped'] += 1
+
+        last_id = _last_book_id(conn)
+        conn.executemany('''
+            INSERT INTO books (title, author, genre, year, publisher, location, language, is_loaned, book_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(*record, key) for key, record in inserts.items()])
+        _index_new_books(conn, last_id)
+        _unindex_books(conn, updates)
+        conn.executemany(
+            f'UPDATE books SET {", ".join(f + " = ?" for f in UPSERT_FIELDS)} WHERE id = ?',
+            [(*(row[f] for f in UPSERT_FIELDS), book_id) for book_id, row in updates.items()])
+        _index_books(conn, [(book_id, row['title'], row['author'], row['publisher']) for book_id, row in updates.items()])
+    if inserts or updates:
+        _mark_written()
+    return stats
+
+def _title_seek(after):
+    """WHERE clause continuing an (title, id) cursor in title COLLATE NOCASE, id order."""
+    if after is None:
+        return "1", ()
+    title, book_id = after
+    if title is None:
+        # NULL titles sort first
+        return "((title IS NULL AND id > ?) OR title IS NOT NULL)", (book_id,)
+    # Spelled out rather than as a row value so SQLite can seek in idx_books_title
+    return "title COLLATE NOCASE >= ? AND (title COLLATE NOCASE > ? OR id > ?)", (title, title, book_id)
+
+def _filter_clause(filters):
+    """WHERE clause for ((column, value), ...) facet filters, all of which must match."""
+    clauses, params = [], []
+    for column, value in filters:
+        if column not in FACETS:
+            raise ValueError(f"Filtro non valido: {column}")
+        if value == '':
+            clauses.append(f"COALESCE({column}, '') = ''") # Same as facet_counts: NULL or empty
+        elif column == 'is_loaned':
+            # A literal rather than a parameter lets SQLite use the idx_books_loaned partial index
+            clauses.append(f"is_loaned = {int(value)}")
+        else:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    return " AND ".join(clauses) or "1", tuple(params)
+
+def _browse_page(after, limit, filters=()):
+    seek, params = _title_seek(after)
+    where, filter_params = _filter_clause(filters)
+    return _fetch(f'''
+        SELECT {BOOK_COLUMNS} FROM books WHERE {where} AND {seek}
+        ORDER BY title COLLATE NOCASE, id
+        LIMIT ?
+    ''', filter_params + params + (limit,)).fetchall()
+
+def _fts_page(fts_query, after, limit, filters=()):
+    seek, params = "1", ()
+    if after is not None:
+        seek, params = "(rank, id) > (?, ?)", tuple(after)
+    where, filter_params = _filter_clause(filters)
+    # Weights per column: title, author, genre, publisher
+    return _fetch(f'''
+        SELECT {BOOK_COLUMNS}, rank FROM (
+            SELECT books.*, bm25(books_fts, 10.0, 5.0, 1.0, 2.0) AS rank FROM books_fts
+            JOIN books ON books.id = books_fts.rowid
+            WHERE books_fts MATCH ?
+        ) WHERE {where} AND {seek}
+        ORDER BY rank, id
+        LIMIT ?
+    ''', (fts_query,) + filter_params + params + (limit,)).fetchall()
+    
+def _like_page(query, after, limit, filters=()):
+    seek, params = _title_seek(after)
+    where, filter_params = _filter_clause(filters)
     query_param = f"%{query}%"
-    books = conn.execute('''
-        SELECT * FROM books 
-        WHERE title LIKE ? OR author LIKE ? OR genre LIKE ? OR publisher LIKE ?
-        ORDER BY title COLLATE NOCASE
-        LIMIT ? OFFSET ?
-    ''', (query_param, query_param, query_param, query_param, limit, offset)).fetchall()
-    conn.close()
-    return books
+    return _fetch(f'''
+        SELECT {BOOK_COLUMNS} FROM books 
+        WHERE (title LIKE ? OR author LIKE ? OR genre LIKE ? OR publisher LIKE ?) AND {where} AND {seek}
+        ORDER BY title COLLATE NOCASE, id
+        LIMIT ?
+    ''', (query_param, query_param, query_param, query_param) + filter_params + params + (limit,)).fetchall()
+
+# Position of the sort key of each cursor kind in the raw rows of the _page functions
+_SORT_COLUMN = {"title": BOOK_FIELDS.index("title"), "rank": len(BOOK_FIELDS)}
+
+@cached_read
+def get_books_page(query="", after=None, limit=50, filters=()):
+    """
+    Keyset pagination: returns (books, next_cursor). Pass next_cursor back as `after`
+    to get the following page; it is None when there are no more books.
+    Browsing is ordered by title, searches by BM25 rank (title when FTS5 is missing).
+    filters: ((column, value), ...) facet filters, e.g. (('genre', 'Giallo'),); a tuple
+    so that results can be cached.
+    """
+    kind, key = after if after else (None, None)
+    fts_query = build_fts_query(query) if query and fts_enabled() else ""
+
+    if not query:
+        kind, rows = "title", _browse_page(key, limit + 1, filters)
+    elif fts_query and kind in (None, "rank"):
+        try:
+            kind, rows = "rank", _fts_page(fts_query, key, limit + 1, filters)
+        except sqlite3.OperationalError:
+            # Corrupted/missing index: use the slow path, unless we are mid-way through ranked pages
+            if kind == "rank":
+                return [], None
+            kind, rows = "title", _like_page(query, None, limit + 1, filters)
+    else:
+        kind, rows = "title", _like_page(query, key if kind == "title" else None, limit + 1, filters)
+
+    # Rows are plain tuples here so the cursor can be read off the last one (rank is not a Book field)
+    fields = len(BOOK_FIELDS)
+    books = [Book(*row[:fields]) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return books, None
+    last = rows[limit - 1]
+    return books, (kind, (last[_SORT_COLUMN[kind]], last[0]))
 
+def get_book(book_id):
+    """The book with that id, or None."""
+    return _fetch(f'SELECT {BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,), row_factory=book_factory).fetchone()
+
+def get_all_books(limit=50, after=None):
+    return get_books_page("", after, limit)[0]
+
+def search_books(query, limit=50, after=None):
+    """Full-text search ranked by BM25; falls back to LIKE when FTS5 is unavailable."""
+    return get_books_page(query, after, limit)[0]
+
+@retry_busy
 def update_book(book_id, title, author, genre, year, publisher, location, language, is_loaned, loaned_to=None):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        UPDATE books 
-        SET title = ?, author = ?, genre = ?, year = ?, publisher = ?, location = ?, language = ?, is_loaned = ?, loaned_to = ?
-        WHERE id = ?
-    ''', (title, author, genre, year, publisher, location, language, is_loaned, loaned_to, book_id))
-    conn.commit()
-    conn.close()
+    key = book_key(title, author, year, publisher)
+    with write_transaction() as conn:
+        _unindex_books(conn, [book_id])
+        old_keys = _book_keys(conn, [book_id])
+        cursor = conn.execute('''
+            UPDATE books 
+            SET title = ?, author = ?, genre = ?, year = ?, publisher = ?, location = ?, language = ?, is_loaned = ?, loaned_to = ?,
+                book_key = (SELECT CASE WHEN EXISTS (SELECT 1 FROM books WHERE book_key = ? AND id != ?) THEN NULL ELSE ? END)
+            WHERE id = ?
+        ''', (title, author, genre, year, publisher, location, language, is_loaned, loaned_to, key, book_id, key, book_id))
+        if cursor.rowcount:
+            _index_books(conn, [(book_id, title, author, publisher)])
+            _hand_over_keys(conn, old_keys)
+    _mark_written()
 
+@retry_busy
 def delete_book(book_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM books WHERE id = ?', (book_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        _unindex_books(conn, [book_id])
+        old_keys = _book_keys(conn, [book_id])
+        conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+        _hand_over_keys(conn, old_keys)
+    _mark_written()
 
+@retry_busy
 def toggle_loan_status(book_id, current_status, loaned_to=None):
+    """Lends (current_status 0) or returns (1) a book; the loans table records the event."""
     new_status = 0 if current_status == 1 else 1
     if new_status == 0:
         loaned_to = None # Clear when returned
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE books SET is_loaned = ?, loaned_to = ? WHERE id = ?', (new_status, loaned_to, book_id))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute('UPDATE books SET is_loaned = ?, loaned_to = ? WHERE id = ?', (new_status, loaned_to, book_id))
+    _mark_written()
     return new_status
 
+# --- Loan history (see _migration_loans) ---
+
+LOAN_DAYS = 30 # A loan open for longer than this is overdue
+
+LOAN_FIELDS = ('id', 'book_id', 'borrower', 'loaned_at', 'returned_at', 'title', 'author')
+
+class Loan:
+    """One row of the loans table, with the title and author of the book (None if deleted)."""
+    __slots__ = LOAN_FIELDS
+
+    def __init__(self, id, book_id, borrower, loaned_at, returned_at, title=None, author=None):
+        self.id = id
+        self.book_id = book_id
+        self.borrower = borrower
+        self.loaned_at = loaned_at
+        self.returned_at = returned_at
+        self.title = title
+        self.author = author
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"Loan(book_id={self.book_id!r}, borrower={self.borrower!r}, loaned_at={self.loaned_at!r})"
+
+    def as_dict(self):
+        return {f: getattr(self, f) for f in LOAN_FIELDS}
+
+def loan_factory(cursor, row):
+    return Loan(*row)
+
+_LOAN_SELECT = '''
+    SELECT loans.id, book_id, borrower, loaned_at, returned_at, books.title, books.author
+    FROM loans LEFT JOIN books ON books.id = loans.book_id
+'''
+
+# Loan queries are not cached: "overdue" changes with the clock, not with writes
+
+@perf.timed("db.get_current_loans", rows=len)
+def get_current_loans():
+    """Open loans, oldest first (idx_loans_open)."""
+    return _fetch(f'{_LOAN_SELECT} WHERE returned_at IS NULL ORDER BY loaned_at',
+                  row_factory=loan_factory).fetchall()
+
+@perf.timed("db.get_overdue_loans", rows=len)
+def get_overdue_loans(days=LOAN_DAYS):
+    """Open loans older than days, oldest first."""
+    return _fetch(f'''{_LOAN_SELECT}
+        WHERE returned_at IS NULL AND loaned_at < datetime('now', ?)
+        ORDER BY loaned_at
+    ''', (f'-{int(days)} days',), row_factory=loan_factory).fetchall()
+
+@perf.timed("db.get_borrower_loans", rows=len)
+def get_borrower_loans(borrower, open_only=False):
+    """Loans to borrower (case insensitive), newest first; open_only for what they still have."""
+    where = " AND returned_at IS NULL" if open_only else ""
+    return _fetch(f'''{_LOAN_SELECT}
+        WHERE borrower = ? COLLATE NOCASE{where}
+        ORDER BY loaned_at DESC, loans.id DESC
+    ''', (borrower,), row_factory=loan_factory).fetchall()
+
+@perf.timed("db.get_book_loans", rows=len)
+def get_book_loans(book_id):
+    """Loan history of one book, newest first."""
+    return _fetch(f'{_LOAN_SELECT} WHERE book_id = ? ORDER BY loaned_at DESC, loans.id DESC',
+                  (book_id,), row_factory=loan_factory).fetchall()
+
+# --- Change tracking: what changed since a watermark (see _migration_change_log) ---
+
+def change_seq():
+    """Number of the latest change to the books; a watermark for iter_changes()."""
+    return get_db_connection().execute('SELECT COALESCE(MAX(seq), 0) FROM book_changes').fetchone()[0]
+
+def iter_changes(since, until=None, batch_size=1000):
+    """
+    Streams the books changed after watermark since (up to until, included), oldest
+    change first, as (op, book_id, changed_at, book) with op 'insert', 'update' or
+    'delete' relative to since; book is None for deletions. A book shows up once, with
+    its current state. Books added and deleted again in between are left out.
+    """
+    until = change_seq() if until is None else until
+    cursor = _fetch(f'''
+        SELECT c.inserted_seq, c.deleted, c.changed_at, c.book_id, {", ".join("b." + f for f in BOOK_FIELDS)}
+        FROM book_changes c LEFT JOIN books b ON b.id = c.book_id
+        WHERE c.seq > ?1 AND c.seq <= ?2 AND NOT (c.deleted AND c.inserted_seq > ?1)
+        ORDER BY c.seq
+    ''', (since, until))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for inserted_seq, deleted, changed_at, book_id, *book in rows:
+            op = 'delete' if deleted else 'insert' if inserted_seq > since else 'update'
+            yield op, book_id, changed_at, None if deleted else Book(*book)
+
+def get_export_watermark(target):
+    """change_seq() of the last delta export to target, or None if there was none."""
+    row = get_db_connection().execute('SELECT seq FROM export_watermarks WHERE target = ?', (target,)).fetchone()
+    return row[0] if row else None
+
+@retry_busy
+def set_export_watermark(target, seq):
+    with write_transaction() as conn:
+        conn.execute('''
+            INSERT INTO export_watermarks (target, seq, exported_at) VALUES (?, ?, datetime('now'))
+            ON CONFLICT (target) DO UPDATE SET seq = excluded.seq, exported_at = excluded.exported_at
+        ''', (target, seq))
+
+# --- Batch writes: many books, one transaction (one commit/fsync) ---
+
+# Columns update_books() may set; book_key and the search indexes follow automatically
+BATCH_FIELDS = BOOK_FIELDS[1:]
+_KEY_FIELDS = ('title', 'author', 'year', 'publisher')
+_FUZZY_FIELDS = ('title', 'author', 'publisher')
+# Columns rename_value() works on: shared values, as in the facets and autocomplete
+RENAME_FIELDS = ('author', 'genre', 'publisher', 'location', 'language')
+# Books per transaction when rename_value() also has to update search words and keys
+RENAME_CHUNK = 1000
+
+def _rows_by_id(conn, book_ids, columns):
+    for placeholders, batch in _in_batches(book_ids):
+        yield from conn.execute(f'SELECT id, {columns} FROM books WHERE id IN ({placeholders})', batch)
+
+def _update_ids(conn, book_ids, changes):
+    """Applies changes ({column: value}) to book_ids inside the caller's transaction."""
+    fuzzy = any(f in changes for f in _FUZZY_FIELDS)
+    if fuzzy:
+        _unindex_books(conn, book_ids)
+    assignments = ", ".join(f + " = ?" for f in changes)
+    for placeholders, batch in _in_batches(book_ids):
+        conn.execute(f'UPDATE books SET {assignments} WHERE id IN ({placeholders})', (*changes.values(), *batch))
+    if fuzzy:
+        _index_books(conn, _rows_by_id(conn, book_ids, 'title, author, publisher'))
+    if any(f in changes for f in _KEY_FIELDS):
+        rows = list(_rows_by_id(conn, book_ids, 'title, author, year, publisher, book_key'))
+        # Release the old keys first, so books in the batch can swap keys between them
+        conn.executemany('UPDATE books SET book_key = NULL WHERE id = ?', ((row[0],) for row in rows))
+        conn.executemany(f'UPDATE books SET book_key = {_NEW_KEY_SQL} WHERE id = ?2',
+                         ((book_key(*row[1:5]), row[0]) for row in rows))
+        _hand_over_keys(conn, [row[5] for row in rows])
+
+@retry_busy
+def update_books(book_ids, changes):
+    """
+    Sets the same values on many books in one transaction, e.g. re-shelving:
+    update_books(ids, {'location': 'B3'}). Returns the number of books changed.
+    """
+    invalid = [f for f in changes if f not in BATCH_FIELDS]
+    if invalid:
+        raise ValueError(f"Campi non validi: {', '.join(invalid)}")
+    book_ids = list(dict.fromkeys(book_ids))
+    if not book_ids or not changes:
+        return 0
+    with write_transaction() as conn:
+        book_ids = [row[0] for row in _rows_by_id(conn, book_ids, 'id')] # Only the ones that exist
+        _update_ids(conn, book_ids, dict(changes))
+    _mark_written()
+    return len(book_ids)
+
+@retry_busy
+def delete_books(book_ids):
+    """Deletes many books in one transaction. Returns the number deleted."""
+    book_ids = list(dict.fromkeys(book_ids))
+    with write_transaction() as conn:
+        _unindex_books(conn, book_ids)
+        old_keys = _book_keys(conn, book_ids)
+        deleted = conn.executemany('DELETE FROM books WHERE id = ?', ((book_id,) for book_id in book_ids)).rowcount
+        _hand_over_keys(conn, old_keys)
+    _mark_written()
+    return deleted
+
+@retry_busy
+def rename_value(column_name, old_value, new_value):
+    """
+    Replaces old_value with new_value in column_name on every book that has it, e.g. to fix
+    a misspelled publisher. Returns the number of books changed.
+    genre, location and language take a single UPDATE. author and publisher also change
+    search words and keys, so they go RENAME_CHUNK books per transaction: other writers
+    only wait for one chunk, and if it stops half-way running it again finishes the job.
+    """
+    if column_name not in RENAME_FIELDS:
+        raise ValueError(f"Campo non valido: {column_name}")
+    if old_value == new_value:
+        return 0
+    if column_name not in _FUZZY_FIELDS and column_name not in _KEY_FIELDS:
+        with write_transaction() as conn:
+            changed = conn.execute(f'UPDATE books SET {column_name} = ? WHERE {column_name} = ?',
+                                   (new_value, old_value)).rowcount
+    else:
+        changed = 0
+        while True:
+            with write_transaction() as conn:
+                book_ids = [row[0] for row in conn.execute(
+                    f'SELECT id FROM books WHERE {column_name} = ? LIMIT ?', (old_value, RENAME_CHUNK))]
+                if book_ids:
+                    _update_ids(conn, book_ids, {column_name: new_value})
+            if not book_ids:
+                break
+            changed += len(book_ids)
+            _mark_written() # Each chunk is visible as soon as it is committed
+    if changed:
+        _mark_written()
+    return changed
+
+@cached_read
 def get_unique_values(column_name):
     """Returns a list of unique values for a given column, used for autocomplete."""
     valid_columns = ["author", "genre", "publisher", "location", "language"]
@@ -101,15 +1301,67 @@ def get_unique_values(column_name):
     conn = get_db_connection()
     # Using ORDER BY for better UI presentation
     rows = conn.execute(f'SELECT DISTINCT {column_name} FROM books WHERE {column_name} IS NOT NULL AND {column_name} != "" ORDER BY {column_name} COLLATE NOCASE').fetchall()
-    conn.close()
     return [row[0] for row in rows]
 
+@perf.timed("db.get_all_books_sorted", rows=len)
 def get_all_books_sorted():
     """Returns all books sorted by title for export."""
+    return _fetch(f'SELECT {BOOK_COLUMNS} FROM books ORDER BY title COLLATE NOCASE, id',
+                  row_factory=book_factory).fetchall()
+
+def iter_books_sorted(batch_size=1000):
+    """Like get_all_books_sorted() but streams rows from the cursor, for large exports."""
+    cursor = _fetch(f'SELECT {BOOK_COLUMNS} FROM books ORDER BY title COLLATE NOCASE, id',
+                    row_factory=book_factory)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+@cached_read
+def get_facets(filters=(), limit=None):
+    """
+    Book counts per value of each of the FACETS: {facet: [(value, count), ...]}, most
+    common first, at most limit values per facet ('' counts books with no value).
+    Without filters the counts come straight from facet_counts; with filters (as in
+    get_books_page) only the matching books are grouped, through the filter's index.
+    """
+    where, params = _filter_clause(filters)
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title COLLATE NOCASE').fetchall()
-    conn.close()
-    return [dict(b) for b in books]
+    table = "books"
+    if filters:
+        # Through an index every match costs a random row lookup: when the filters keep a
+        # large share of the library one sequential scan per facet is much faster
+        total = conn.execute("SELECT COALESCE(SUM(count), 0) FROM facet_counts WHERE facet = 'is_loaned'").fetchone()[0]
+        matches = min(conn.execute('SELECT COALESCE(MAX(count), 0) FROM facet_counts WHERE facet = ? AND value = ?',
+                                   (column, int(value) if column == 'is_loaned' and value != '' else value)).fetchone()[0]
+                      for column, value in filters)
+        if matches * 4 > total:
+            table = "books NOT INDEXED"
+    facets = {}
+    for facet in FACETS:
+        if filters:
+            rows = conn.execute(f'''
+                SELECT COALESCE({facet}, ''), COUNT(*) AS count FROM {table} WHERE {where}
+                GROUP BY 1 ORDER BY count DESC, 1 LIMIT ?
+            ''', params + (limit or -1,))
+        else:
+            rows = conn.execute('''
+                SELECT value, count FROM facet_counts WHERE facet = ? AND count > 0
+                ORDER BY count DESC, value LIMIT ?
+            ''', (facet, limit or -1))
+        facets[facet] = [tuple(row) for row in rows]
+    return facets
 
-# Initialize DB on import
-create_table()
+@retry_busy
+def rebuild_facet_counts():
+    """Recounts facet_counts from scratch, e.g. after editing library.db with other tools."""
+    with write_transaction() as conn:
+        _count_facets(conn)
+    _mark_written()
+
+@cached_read
+def count_books():
+    conn = get_db_connection()
+    return conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
@@ -0,0 +1,91 @@
+"""
+Runs database calls on a single background thread, so the Tk main loop never waits
+for the disk. Results come back as concurrent.futures.Future objects, and the
+on_done/on_error callbacks are called on the Tk thread (polled with after()).
+"""
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import perf
+
+class DBWorker:
+    def __init__(self, widget, poll_ms=20):
+        self.widget = widget
+        self.poll_ms = poll_ms
+        self.pending = 0 # Submitted and not yet delivered; only touched on the Tk thread
+        self.on_pending_change = None # Called with the new count
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._polling = False
+        self._thread = threading.Thread(target=self._run, name="db-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, on_done=None, on_error=None, **kwargs):
+        """
+        Queues fn(*args, **kwargs) for the worker thread. on_done(result) or on_error(exception)
+        then runs on the Tk thread; errors without on_error go to Tk's error reporting.
+        Returns the Future; cancel() on it drops the call if it has not started yet.
+        """
+        future = Future()
+        self._requests.put((future, fn, args, kwargs, on_done, on_error, time.perf_counter()))
+        self._set_pending(self.pending + 1)
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_ms, self._poll)
+        return future
+
+    def stop(self, timeout=5):
+        """Lets the queued calls finish (e.g. a save), then ends the thread."""
+        self._requests.put(None)
+        self._thread.join(timeout)
+
+    def _set_pending(self, count):
+        self.pending = count
+        if self.on_pending_change:
+            self.on_pending_change(count)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            future, fn, args, kwargs, on_done, on_error, queued_at = request
+            if future.set_running_or_notify_cancel():
+                # Time spent behind other calls: the part of the latency the query itself doesn't explain
+                perf.record("worker.queue_wait", (time.perf_counter() - queued_at) * 1000)
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            self._results.put((future, on_done, on_error))
+
+    def _poll(self):
+        delivered = 0
+        while True:
+            try:
+                future, on_done, on_error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            delivered += 1
+            if future.cancelled():
+                continue
+            try:
+                error = future.exception()
+                if error is None:
+                    if on_done:
+                        on_done(future.result())
+                elif on_error:
+                    on_error(error)
+                else:
+                    raise error
+            except Exception:
+                # e.g. the widget waiting for the result was closed meanwhile
+                self.widget.report_callback_exception(*sys.exc_info())
+        if delivered:
+            self._set_pending(self.pending - delivered)
+        if self.pending:
+            self.widget.after(self.poll_ms, self._poll)
+        else:
+            self._polling = False
@@ -0,0 +1,172 @@
+import csv
+import os
+import database
+import perf
+
+# DB column -> header in the exported file
+COLUMNS_MAP = {
+    'title': 'Titolo',
+    'author': 'Autore',
+    'genre': 'Genere',
+    'year': 'Anno',
+    'publisher': 'Editore',
+    'location': 'Posizione',
+    'language': 'Lingua',
+    'is_loaned': 'In Prestito',
+    'loaned_to': 'Prestato a'
+}
+
+FORMATS = ("xlsx", "csv", "tsv")
+
+# Delta exports (export_changes): one row per changed book, with these columns first
+CHANGE_LABELS = {'insert': 'Nuovo', 'update': 'Modificato', 'delete': 'Eliminato'}
+CHANGE_COLUMNS = ['Modifica', 'ID', 'Data modifica (UTC)']
+DEFAULT_TARGET = "backup"
+
+def export_row(book):
+    """Values of one database.Book in COLUMNS_MAP order, with the loan flag as 'Sì'/'No'."""
+    return [book.title, book.author, book.genre, book.year, book.publisher, book.location,
+            book.language, 'Sì' if book.is_loaned == 1 else 'No', book.loaned_to]
+
+class _XlsxWriter:
+    def __init__(self, path):
+        from openpyxl import Workbook # Only needed for Excel files
+        self.path = path
+        # Write-only mode streams rows to a temp file instead of keeping cells in memory
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+
+    def write(self, row):
+        self.sheet.append(row)
+
+    def close(self, save=True):
+        if save:
+            self.workbook.save(self.path)
+        else:
+            self.workbook.close()
+
+class _CsvWriter:
+    def __init__(self, path, delimiter):
+        # utf-8-sig so that Excel detects accented letters correctly
+        self.file = open(path, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.file, delimiter=delimiter)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self, save=True):
+        self.file.close()
+
+def _open_writer(path, fmt):
+    if fmt == "xlsx":
+        return _XlsxWriter(path)
+    return _CsvWriter(path, "\t" if fmt == "tsv" else ",")
+
+def _format(path, fmt):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower() or "xlsx"
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato non supportato: {fmt}")
+    return fmt
+
+def _write_file(path, fmt, header, rows, total, progress=None, cancel_event=None, batch_size=1000):
+    """Writes header and rows (closing the rows generator at the end); see export_books()."""
+    # Written next to the target and renamed at the end: a cancelled or failed
+    # export never leaves a half-written file or destroys the previous one
+    tmp_path = path + ".tmp"
+    writer = _open_writer(tmp_path, fmt)
+    done = 0
+    cancelled = False
+    try:
+        writer.write(header)
+        for row in rows:
+            writer.write(row)
+            done += 1
+            if done % batch_size == 0:
+                if cancel_event is not None and cancel_event.is_set():
+                    cancelled = True
+                    break
+                if progress:
+                    progress(done, total)
+        writer.close(save=not cancelled)
+    except BaseException:
+        writer.close(save=False)
+        cancelled = True
+        raise
+    finally:
+        rows.close()
+        if cancelled and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if cancelled:
+        return None
+    os.replace(tmp_path, path)
+    if progress:
+        progress(done, total)
+    return done
+
+@perf.timed("export.books", rows=lambda done: done or 0)
+def export_books(path, fmt=None, progress=None, cancel_event=None, batch_size=1000):
+    """
+    Streams every book, sorted by title, from the DB cursor into path, so memory stays
+    constant whatever the size of the catalog. fmt is 'xlsx', 'csv' or 'tsv' (default:
+    from the file extension). progress(done, total) is called every batch_size rows;
+    setting cancel_event stops the export and removes the partial file.
+    Returns the number of books written, or None if cancelled.
+    """
+    fmt = _format(path, fmt)
+    total = database.count_books()
+    rows = (export_row(book) for book in database.iter_books_sorted(batch_size))
+    return _write_file(path, fmt, list(COLUMNS_MAP.values()), rows, total, progress, cancel_event, batch_size)
+
+def _change_rows(changes):
+    for op, book_id, changed_at, book in changes:
+        values = export_row(book) if book is not None else [None] * len(COLUMNS_MAP)
+        yield [CHANGE_LABELS[op], book_id, changed_at, *values]
+
+@perf.timed("export.changes", rows=lambda counts: sum(counts.values()))
+def export_changes(path, target=DEFAULT_TARGET, fmt=None, full=False):
+    """
+    Delta export for syncing a copy of the catalog: writes only the books inserted,
+    updated or deleted since the previous export_changes() to the same target, so the
+    cost follows the number of changes, not the size of the catalog. The first time
+    (or with full) every book is written, as 'Nuovo'. The watermark only moves once
+    the file is complete, so a failed run is simply repeated by the next one.
+    Returns {'insert': n, 'update': n, 'delete': n}.
+    """
+    fmt = _format(path, fmt)
+    since = None if full else database.get_export_watermark(target)
+    until = database.change_seq() # Changes made while exporting go to the next run
+    counts = dict.fromkeys(CHANGE_LABELS, 0)
+    if since is None:
+        changes = (('insert', book.id, None, book) for book in database.iter_books_sorted())
+    else:
+        changes = database.iter_changes(since, until)
+
+    def counted():
+        for change in changes:
+            counts[change[0]] += 1
+            yield change
+    rows = _change_rows(counted())
+    _write_file(path, fmt, CHANGE_COLUMNS + list(COLUMNS_MAP.values()), rows, None)
+    database.set_export_watermark(target, until)
+    return counts
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Esporta il catalogo di library.db")
+    parser.add_argument("file", help="file .xlsx, .csv o .tsv da scrivere")
+    parser.add_argument("--changes", action="store_true",
+                        help="solo i libri nuovi, modificati o eliminati dall'ultima esportazione --changes")
+    parser.add_argument("--target", default=DEFAULT_TARGET,
+                        help="nome della copia da sincronizzare: ognuna ricorda la propria ultima esportazione")
+    parser.add_argument("--full", action="store_true", help="con --changes: riparte da tutti i libri")
+    args = parser.parse_args()
+    database.create_table()
+    try:
+        if args.changes:
+            counts = export_changes(args.file, args.target, full=args.full)
+            print(f"Nuovi: {counts['insert']}, modificati: {counts['update']}, eliminati: {counts['delete']}")
+        else:
+            print(f"Esportati {export_books(args.file)} libri")
+    finally:
+        database.close_all_connections()
@@ -1,11 +1,19 @@
-import pandas as pd
-import sqlite3
+import argparse
+import codecs
+import csv
+import multiprocessing
 import os
-from database import create_table, get_db_connection
+import queue
+import time
+from database import create_table, add_books, upsert_books, close_all_connections
 
 EXCEL_FILE = "excel_file.xlsx"
 DB_NAME = "library.db"
 
+# Rows are read and inserted in chunks of this size, each in its own transaction,
+# so memory stays flat and a bad row only loses its own chunk
+CHUNK_SIZE = 1000
+
 # Mapping from Excel headers to DB columns
 # Adjust 'possible_names' lists based on your actual Excel file
 COLUMN_MAPPING = {
@@ -19,70 +27,268 @@ COLUMN_MAPPING = {
     # unless they already exist.
 }
 
-def import_data():
-    if not os.path.exists(EXCEL_FILE):
-        print(f"Errore: File '{EXCEL_FILE}' non trovato.")
-        return
+# Read with the csv module, without openpyxl; delimiter and encoding are detected
+TEXT_EXTENSIONS = (".csv", ".tsv", ".txt")
+# File types import_files() picks up when given a directory. Not .txt: a folder's
+# README or notes would be read as CSV, so .txt files are imported only when named
+SUPPORTED_EXTENSIONS = (".xlsx", ".xlsm", ".csv", ".tsv")
+SNIFF_BYTES = 64 * 1024
+
+# Language: default empty or 'Italiano'? User didn't specify default, leave None or ask?
+# Let's set default language to 'Italiano' if missing, just a guess, or empty string.
+DEFAULT_LANGUAGE = 'Italiano'
 
-    print("Lettura file Excel...")
+def sniff_encoding(sample):
+    """Encoding of a text file from its first bytes: BOM, else UTF-8 if it decodes, else Windows Latin-1."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
     try:
-        df = pd.read_excel(EXCEL_FILE)
-    except Exception as e:
-        print(f"Errore lettura Excel: {e}")
+        # Incremental, so a character cut at the end of the sample is not an error
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252" # What Excel uses for "CSV" on Italian Windows
+
+def sniff_delimiter(sample, path):
+    """Delimiter of a CSV/TSV text sample: comma, semicolon (Excel in Italian), tab or pipe."""
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error: # e.g. a single column
+        return "\t" if path.lower().endswith(".tsv") else ","
+
+def read_rows(path):
+    """Yields the header row and then each data row, without loading the whole file."""
+    if os.path.splitext(path)[1].lower() in TEXT_EXTENSIONS:
+        with open(path, "rb") as f:
+            encoding = sniff_encoding(f.read(SNIFF_BYTES))
+        with open(path, newline="", encoding=encoding) as f:
+            delimiter = sniff_delimiter(f.read(SNIFF_BYTES), path)
+            f.seek(0)
+            yield from csv.reader(f, delimiter=delimiter)
         return
 
-    print(f"Colonne trovate: {df.columns.tolist()}")
+    from openpyxl import load_workbook # Only needed for Excel files
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
 
-    # Normalize columns
-    df_clean = pd.DataFrame()
+def map_columns(header, log=print):
+    """Returns {db column: index in the row} using COLUMN_MAPPING (case insensitive)."""
+    header = [str(col).strip() if col is not None else "" for col in header]
+    log(f"Colonne trovate: {header}")
 
+    mapping = {}
     for db_col, possible_names in COLUMN_MAPPING.items():
-        found = False
         for name in possible_names:
-            # Case insensitive search
-            match = next((col for col in df.columns if col.lower() == name.lower()), None)
-            if match:
-                df_clean[db_col] = df[match]
-                found = True
-                print(f"Mappato '{match}' -> '{db_col}'")
+            match = next((i for i, col in enumerate(header) if col.lower() == name.lower()), None)
+            if match is not None:
+                mapping[db_col] = match
+                log(f"Mappato '{header[match]}' -> '{db_col}'")
                 break
-        
-        if not found:
-            print(f"Attenzione: Colonna per '{db_col}' non trovata. Sarà vuota.")
-            df_clean[db_col] = None
-
-    # Handle new columns
-    # Language: default empty or 'Italiano'? User didn't specify default, leave None or ask?
-    # Let's set default language to 'Italiano' if missing, just a guess, or empty string.
-    if 'language' not in df_clean.columns:
-         df_clean['language'] = 'Italiano' # Default assumption
-    
-    # is_loaned: default 0
-    df_clean['is_loaned'] = 0
+        else:
+            log(f"Attenzione: Colonna per '{db_col}' non trovata. Sarà vuota.")
+    return mapping
+
+def _clean(value):
+    if isinstance(value, str):
+        value = value.strip()
+        return value if value else None
+    return value
+
+def normalize_rows(rows, mapping):
+    """Turns raw rows into (title, author, genre, year, publisher, location, language, is_loaned) tuples."""
+    for row in rows:
+        values = [_clean(row[mapping[col]]) if col in mapping and mapping[col] < len(row) else None
+                  for col in COLUMN_MAPPING]
+        if all(v is None for v in values):
+            continue # Blank line
+        yield (*values, DEFAULT_LANGUAGE, 0)
+
+def chunked(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _write_chunk(chunk, upsert, stats):
+    try:
+        if upsert:
+            for name, count in upsert_books(chunk).items():
+                stats[name] += count
+        else:
+            add_books(chunk)
+            stats['inserted'] += len(chunk)
+    except Exception as e:
+        # Only this chunk is rolled back, earlier ones are already saved
+        stats['failed'] += len(chunk)
+        print(f"Errore in un blocco di {len(chunk)} righe, scartato: {e}")
+
+def import_data(path=EXCEL_FILE, chunk_size=CHUNK_SIZE, progress=None, upsert=True):
+    """
+    Streams the file into the DB in chunks. With upsert (default) books already in
+    the DB are matched on title+author+year+publisher and updated or skipped, so the
+    same file can be imported again safely; otherwise every row is appended.
+    Returns {'inserted', 'updated', 'skipped', 'failed'} row counts.
+    """
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    if not os.path.exists(path):
+        print(f"Errore: File '{path}' non trovato.")
+        return stats
+
+    print(f"Lettura file '{path}'...")
+    try:
+        rows = read_rows(path)
+        header = next(rows, None)
+    except Exception as e:
+        print(f"Errore lettura file: {e}")
+        return stats
+    if header is None:
+        print("Il file è vuoto.")
+        return stats
+
+    mapping = map_columns(header)
 
     # Ensure table exists
     create_table()
 
-    # Insert into DB
-    conn = get_db_connection()
-    
-    # Convert DataFrame to list of tuples for sqlite3
-    # Schema: title, author, genre, year, publisher, location, language, is_loaned
-    # Ensure order matches
-    
-    records = df_clean[['title', 'author', 'genre', 'year', 'publisher', 'location', 'language', 'is_loaned']].values.tolist()
-    
-    print(f"Importazione di {len(records)} libri...")
-    
-    c = conn.cursor()
-    c.executemany('''
-        INSERT INTO books (title, author, genre, year, publisher, location, language, is_loaned)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', records)
-    
-    conn.commit()
-    conn.close()
-    print("Importazione completata con successo!")
+    try:
+        for chunk in chunked(normalize_rows(rows, mapping), chunk_size):
+            _write_chunk(chunk, upsert, stats)
+            if progress:
+                progress(stats)
+            else:
+                print(f"Nuovi: {stats['inserted']}, aggiornati: {stats['updated']}, invariati: {stats['skipped']}...")
+    except Exception as e:
+        print(f"Errore lettura file: {e} ({stats['inserted'] + stats['updated']} libri già salvati)")
+        return stats
+    finally:
+        close_all_connections()
+
+    if stats['failed']:
+        print(f"Importazione terminata con errori: {stats['failed']} righe scartate.")
+    else:
+        print("Importazione completata con successo!")
+    print(f"Libri nuovi: {stats['inserted']}, aggiornati: {stats['updated']}, invariati: {stats['skipped']}")
+    return stats
+
+def find_files(paths):
+    """The given files, plus every SUPPORTED_EXTENSIONS file inside the given directories (sorted)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith("~$"))
+        else:
+            files.append(path)
+    return files
+
+_parsed = None # Queue to the writer, set in each pool process by _init_parser
+
+def _init_parser(parsed):
+    global _parsed
+    _parsed = parsed
+
+def _parse_file(path, chunk_size):
+    """Pool task: reads and normalizes one file, sending its chunks to the writer process."""
+    log = lambda message: _parsed.put(("log", path, message))
+    try:
+        rows = read_rows(path)
+        header = next(rows, None)
+        if header is None:
+            log("Il file è vuoto.")
+        else:
+            for chunk in chunked(normalize_rows(rows, map_columns(header, log)), chunk_size):
+                _parsed.put(("rows", path, chunk))
+    except Exception as e:
+        _parsed.put(("error", path, str(e)))
+    _parsed.put(("done", path, None))
+
+def import_files(paths, jobs=None, chunk_size=CHUNK_SIZE, upsert=True):
+    """
+    Imports many files (or directories of them) at once. Files are read and normalized
+    in parallel by a pool of `jobs` processes (default: one per CPU), which is where
+    the time goes for Excel files; this process is the only writer and saves their
+    rows as they arrive, chunk_size at a time in one transaction each (rows of small
+    files are grouped together), like import_data().
+    Returns the same counts as import_data(), plus 'files' and 'rows_per_sec'.
+    """
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    files = []
+    for path in find_files(paths):
+        if os.path.exists(path):
+            files.append(path)
+        else:
+            print(f"Errore: File '{path}' non trovato.")
+    if not files:
+        return dict(stats, files=0, rows_per_sec=0)
+
+    create_table()
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files)))
+    print(f"Importazione di {len(files)} file con {jobs} processi...")
+    start = time.perf_counter()
+    # Bounded: if the writer falls behind, the readers wait instead of filling the memory
+    parsed = multiprocessing.Queue(maxsize=jobs * 4)
+    pool = multiprocessing.Pool(jobs, initializer=_init_parser, initargs=(parsed,))
+    try:
+        tasks = pool.starmap_async(_parse_file, [(path, chunk_size) for path in files])
+        remaining = len(files)
+        pending = []
+        while remaining:
+            try:
+                kind, path, payload = parsed.get(timeout=1)
+            except queue.Empty:
+                if tasks.ready() and not tasks.successful():
+                    tasks.get() # A reader process died: raise its error
+                continue
+            name = os.path.basename(path)
+            if kind == "rows":
+                pending.extend(payload)
+                if len(pending) >= chunk_size:
+                    _write_chunk(pending, upsert, stats)
+                    pending = []
+                    print(f"Nuovi: {stats['inserted']}, aggiornati: {stats['updated']}, invariati: {stats['skipped']}...")
+            elif kind == "log":
+                print(f"[{name}] {payload}")
+            elif kind == "error":
+                print(f"[{name}] Errore lettura file: {payload}")
+            else:
+                remaining -= 1
+        if pending:
+            _write_chunk(pending, upsert, stats)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        close_all_connections()
+
+    elapsed = time.perf_counter() - start
+    rows = sum(stats.values())
+    stats.update(files=len(files), rows_per_sec=round(rows / elapsed) if elapsed else rows)
+    print(f"Importati {len(files)} file: {rows} righe in {elapsed:.1f} s ({stats['rows_per_sec']} righe/s)")
+    print(f"Libri nuovi: {stats['inserted']}, aggiornati: {stats['updated']}, invariati: {stats['skipped']}, "
+          f"scartati: {stats['failed']}")
+    return stats
 
 if __name__ == "__main__":
-    import_data()
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Importa libri da file Excel o CSV in library.db")
+    parser.add_argument("files", nargs="*", default=[EXCEL_FILE],
+                        help="file .xlsx, .csv o .tsv, o cartelle che li contengono (default: EXCEL_FILE)")
+    parser.add_argument("--append", action="store_true",
+                        help="aggiunge tutte le righe senza cercare i libri già presenti")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="processi che leggono i file in parallelo (default: uno per CPU)")
+    args = parser.parse_args()
+    if len(args.files) == 1 and not os.path.isdir(args.files[0]):
+        import_data(args.files[0], upsert=not args.append)
+    else:
+        import_files(args.files, jobs=args.jobs, upsert=not args.append)
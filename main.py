@@ -1,12 +1,37 @@
+import time
+STARTUP_STEPS = [("avvio", time.perf_counter())] # Before the other imports, to time them too
+
 import os
 import tkinter as tk
 from tkinter import messagebox
 import customtkinter as ctk
 import database
-import pandas as pd
+import autocomplete
+import exporter
+import perf
+from db_worker import DBWorker
 from tkinter import filedialog
-from PIL import Image
 import sys
+import threading
+import queue
+# PIL is imported in show_welcome(): it is only needed for the logo
+
+def mark_startup(step):
+    STARTUP_STEPS.append((step, time.perf_counter()))
+
+def report_startup():
+    """Prints how long each startup step took, if LIBRARY_STARTUP_TIMING=1 or --startup-timing."""
+    if not (os.environ.get("LIBRARY_STARTUP_TIMING") == "1" or "--startup-timing" in sys.argv):
+        return
+    if sys.stdout is None: # PyInstaller --noconsole
+        return
+    previous = STARTUP_STEPS[0][1]
+    for step, moment in STARTUP_STEPS[1:]:
+        print(f"{step:<24} {(moment - previous) * 1000:8.1f} ms")
+        previous = moment
+    print(f"{'totale':<24} {(previous - STARTUP_STEPS[0][1]) * 1000:8.1f} ms")
+
+mark_startup("import moduli")
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -17,9 +42,330 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+class SearchScheduler:
+    """
+    Debounces search-as-you-type and runs the query on the DB worker.
+    A superseded query is dropped if it has not started yet, or ignored when it
+    finishes; only the latest result is handed to on_result.
+    """
+    def __init__(self, widget, worker, search_fn, on_result, on_error=None, delay_ms=250):
+        self.widget = widget
+        self.worker = worker
+        self.search_fn = search_fn
+        self.on_result = on_result
+        self.on_error = on_error
+        self.delay_ms = delay_ms
+
+        self._after_id = None
+        self._generation = 0
+        self._future = None
+
+    def schedule(self, query):
+        """Runs the query once the user stops typing for delay_ms."""
+        self.cancel()
+        self._after_id = self.widget.after(self.delay_ms, self._dispatch, query)
+
+    def cancel(self):
+        """Forgets any scheduled or running query."""
+        if self._after_id:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+        self._generation += 1
+        if self._future is not None:
+            self._future.cancel() # No-op once the worker has started it
+            self._future = None
+
+    def _dispatch(self, query):
+        self._after_id = None
+        generation = self._generation
+        self._future = self.worker.submit(
+            self.search_fn, query,
+            on_done=lambda result: self._deliver(generation, self.on_result, query, result),
+            on_error=lambda error: self._deliver(generation, self.on_error, error))
+
+    def _deliver(self, generation, callback, *args):
+        if generation == self._generation and callback:
+            self._future = None
+            callback(*args)
+
+class BookCard(ctk.CTkFrame):
+    """One row of VirtualBookList, rebound to another book while scrolling."""
+    def __init__(self, master, open_callback, select_callback):
+        super().__init__(master, fg_color=("gray90", "gray20"))
+        perf.count("ui.book_card.created")
+        self.book = None
+        self.select_callback = select_callback
+
+        # Multi-select mode only (see VirtualBookList.set_select_mode)
+        self.check_var = tk.BooleanVar(value=False)
+        self.checkbox = ctk.CTkCheckBox(self, text="", width=24, variable=self.check_var,
+                                        command=lambda: select_callback(self.book, self.check_var.get()))
+        
+        # Text container for vertical stacking
+        text_frame = ctk.CTkFrame(self, fg_color="transparent")
+        text_frame.pack(side="left", padx=10, pady=10, fill="both", expand=True)
+
+        self.lbl_title = ctk.CTkLabel(text_frame, text="", font=("Arial", 16, "bold"), anchor="w")
+        self.lbl_title.pack(side="top", anchor="w")
+        
+        self.lbl_author = ctk.CTkLabel(text_frame, text="", font=("Arial", 12, "italic"), text_color="gray", anchor="w")
+        self.lbl_author.pack(side="top", anchor="w")
+        
+        # Minimalist View Button
+        btn_view = ctk.CTkButton(self, text="📖", width=40, height=40, font=("Arial", 20),
+                                fg_color="transparent", border_width=1, border_color="white",
+                                command=lambda: open_callback(self.book))
+        btn_view.pack(side="right", padx=10, pady=10)
+        self.text_frame = text_frame
+
+    def set_selectable(self, selectable):
+        if selectable:
+            self.checkbox.pack(side="left", padx=(10, 0), before=self.text_frame)
+        else:
+            self.checkbox.pack_forget()
+
+    def set_book(self, book, checked=False):
+        if self.check_var.get() != checked:
+            self.check_var.set(checked)
+        if book is self.book:
+            return
+        self.book = book
+        title_val = book.title if book.title else "Senza Titolo"
+        year_val = f" ({book.year})" if book.year else ""
+        self.lbl_title.configure(text=f"{title_val}{year_val}")
+        self.lbl_author.configure(text=book.author if book.author else "Autore sconosciuto")
+
+class VirtualBookList(ctk.CTkFrame):
+    """
+    Scrollable list that only creates enough BookCard widgets to fill the visible
+    area and recycles them while scrolling, so rendering cost does not grow with
+    the number of loaded books.
+    """
+    ROW_HEIGHT = 72 # Card plus vertical padding
+    FOOTER_HEIGHT = 70
+
+    def __init__(self, master, open_callback, load_more_callback):
+        super().__init__(master, fg_color=ctk.ThemeManager.theme["CTkFrame"]["top_fg_color"])
+        self.open_callback = open_callback
+        self.books = []
+        self.has_more = False
+        self.cards = [] # (BookCard, canvas item) pool; books[i] is shown by cards[i % len(cards)]
+        self.select_mode = False
+        self.selected = set() # Ids of the checked books: cards are recycled, so state lives here
+        self.on_selection_change = None
+        self._width = 0
+        self.row_height = round(self._apply_widget_scaling(self.ROW_HEIGHT)) # Follows Windows DPI scaling
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+        self.canvas = tk.Canvas(self, highlightthickness=0, borderwidth=0, yscrollincrement=20,
+                                bg=self._apply_appearance_mode(self._fg_color))
+        self.canvas.grid(row=0, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky="ns", pady=5)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+
+        self.btn_load_more = ctk.CTkButton(self.canvas, text="Carica Altri (+10)", 
+                                           command=load_more_callback, fg_color="gray30")
+        self.footer_item = self.canvas.create_window(0, 0, window=self.btn_load_more, anchor="n", state="hidden")
+        self.lbl_message = None
+        self.message_item = self.canvas.create_window(0, 0, anchor="n", state="hidden")
+
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.bind_all(sequence, self.on_mousewheel, add="+")
+
+    def _set_appearance_mode(self, mode_string):
+        super()._set_appearance_mode(mode_string)
+        if hasattr(self, "canvas"):
+            self.canvas.configure(bg=self._apply_appearance_mode(self._fg_color))
+
+    def set_select_mode(self, enabled):
+        self.select_mode = enabled
+        self.selected.clear()
+        for card, _ in self.cards:
+            card.set_selectable(enabled)
+        self.refresh()
+        self._selection_changed()
+
+    def select_book(self, book, checked):
+        if checked:
+            self.selected.add(book.id)
+        else:
+            self.selected.discard(book.id)
+        self._selection_changed()
+
+    def select_all(self):
+        self.selected.update(book.id for book in self.books)
+        self.refresh()
+        self._selection_changed()
+
+    def clear_selection(self):
+        self.selected.clear()
+        self.refresh()
+        self._selection_changed()
+
+    def _selection_changed(self):
+        if self.on_selection_change:
+            self.on_selection_change(len(self.selected))
+
+    def show_books(self, books, has_more=False, append=False):
+        self.canvas.itemconfigure(self.message_item, state="hidden")
+        if append:
+            self.books.extend(books)
+        else:
+            self.books = list(books)
+            self.canvas.yview_moveto(0)
+            # Keep only the checked books that are still listed
+            listed = {book.id for book in self.books}
+            if self.selected - listed:
+                self.selected &= listed
+                self._selection_changed()
+        self.has_more = has_more
+        self.refresh()
+
+    def show_message(self, text="", image=None, pady=20):
+        """Empties the list and shows a label (welcome logo, 'no results'...) instead."""
+        self.books = []
+        if self.selected:
+            self.selected.clear()
+            self._selection_changed()
+        self.has_more = False
+        # Recreated rather than reconfigured: CTkLabel cannot drop an image once set
+        if self.lbl_message:
+            self.lbl_message.destroy()
+        self.lbl_message = ctk.CTkLabel(self.canvas, text=text, image=image, font=("Arial", 14))
+        self.canvas.itemconfigure(self.message_item, window=self.lbl_message, state="normal")
+        self.canvas.coords(self.message_item, self.canvas.winfo_width() // 2, pady)
+        self.canvas.yview_moveto(0)
+        self.refresh()
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def on_mousewheel(self, event):
+        # Bound with bind_all: only react when the pointer is over this list
+        widget, canvas = str(event.widget), str(self.canvas)
+        if not self.winfo_ismapped() or not (widget == canvas or widget.startswith(canvas + ".")):
+            return
+        up = event.num == 4 or event.delta > 0
+        self.canvas.yview_scroll(-3 if up else 3, "units")
+        self.refresh()
+
+    @perf.timed("ui.list.refresh")
+    def refresh(self):
+        """Lays out the pool for the current scroll position, rebinding only the cards that changed row."""
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        row_height = self.row_height
+        total = len(self.books) * row_height
+        footer = round(self._apply_widget_scaling(self.FOOTER_HEIGHT)) if self.has_more else 0
+        self.canvas.configure(scrollregion=(0, 0, width, total + footer))
+
+        # Grow the pool until it covers the visible area (plus one partially visible row)
+        needed = min(len(self.books), height // row_height + 2)
+        if len(self.cards) < needed:
+            while len(self.cards) < needed:
+                card = BookCard(self.canvas, self.open_callback, self.select_book)
+                card.set_selectable(self.select_mode)
+                self.cards.append((card, self.canvas.create_window(5, 0, window=card, anchor="nw")))
+            self._width = 0 # New cards need sizing
+
+        if width != self._width:
+            self._width = width
+            for _, item in self.cards:
+                self.canvas.itemconfigure(item, width=width - 10, height=row_height - 10)
+            self.canvas.coords(self.message_item, width // 2, self.canvas.coords(self.message_item)[1])
+
+        pool = len(self.cards)
+        first = max(0, int(self.canvas.canvasy(0)) // row_height)
+        for index in range(first, first + pool):
+            card, item = self.cards[index % pool]
+            if index < len(self.books):
+                book = self.books[index]
+                card.set_book(book, book.id in self.selected)
+                self.canvas.coords(item, 5, index * row_height + 5)
+                self.canvas.itemconfigure(item, state="normal")
+            else:
+                self.canvas.itemconfigure(item, state="hidden")
+
+        self.canvas.coords(self.footer_item, width // 2, total + 20)
+        self.canvas.itemconfigure(self.footer_item, state="normal" if self.has_more else "hidden")
+
 ctk.set_appearance_mode("System")  # Modes: "System" (standard), "Dark", "Light"
 ctk.set_default_color_theme("blue")  # Themes: "blue" (standard), "green", "dark-blue"
 
+class FacetBar(ctk.CTkFrame):
+    """
+    Filter menus with live book counts (from database.get_facets) and one removable
+    chip per active filter. on_change(filters) gets the new {column: value} dict.
+    """
+    FACETS = [("Genere", "genre"), ("Lingua", "language"), ("Posizione", "location"), ("Stato", "is_loaned")]
+    MAX_VALUES = 30 # Most common values listed in each menu
+
+    def __init__(self, master, worker, on_change):
+        super().__init__(master, fg_color="transparent")
+        self.worker = worker
+        self.on_change = on_change
+        self.filters = {}
+        self.menus = {}
+        self.choices = {} # column -> {menu text: value}
+        for label, column in self.FACETS:
+            menu = ctk.CTkOptionMenu(self, values=[label], width=130,
+                                     command=lambda text, c=column: self.select(c, text))
+            menu.set(label)
+            menu.pack(side="left", padx=(0, 8))
+            self.menus[column] = menu
+        self.chips_frame = ctk.CTkFrame(self, fg_color="transparent")
+        self.chips_frame.pack(side="left", fill="x", expand=True)
+
+    @staticmethod
+    def value_text(column, value):
+        if column == "is_loaned":
+            return "In prestito" if value == 1 else "Disponibili"
+        return value if value != "" else "(nessuno)"
+
+    def refresh(self):
+        filters = tuple(self.filters.items())
+        self.worker.submit(database.get_facets, filters, limit=self.MAX_VALUES,
+                           on_done=lambda facets: self.show_facets(filters, facets))
+
+    @perf.timed("ui.facets.show")
+    def show_facets(self, filters, facets):
+        if filters != tuple(self.filters.items()):
+            return # Counts for filters changed in the meantime
+        for label, column in self.FACETS:
+            menu = self.menus[column]
+            menu.pack_forget()
+            if column in self.filters:
+                continue # Shown as a chip instead
+            self.choices[column] = {f"{self.value_text(column, value)} ({count})": value
+                                    for value, count in facets[column]}
+            menu.configure(values=list(self.choices[column]) or [label])
+            menu.set(label)
+            menu.pack(side="left", padx=(0, 8), before=self.chips_frame)
+
+        for chip in self.chips_frame.winfo_children():
+            chip.destroy()
+        for column, value in self.filters.items():
+            ctk.CTkButton(self.chips_frame, text=f"{self.value_text(column, value)}  ✕", width=0, height=28,
+                          fg_color="transparent", border_width=1, border_color="white",
+                          command=lambda c=column: self.remove(c)).pack(side="left", padx=(0, 6))
+
+    def select(self, column, text):
+        if text not in self.choices.get(column, {}):
+            return # The placeholder label
+        self.filters = {**self.filters, column: self.choices[column][text]}
+        self.refresh()
+        self.on_change(self.filters)
+
+    def remove(self, column):
+        self.filters = {c: v for c, v in self.filters.items() if c != column}
+        self.refresh()
+        self.on_change(self.filters)
+
 class App(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -55,8 +401,27 @@ class App(ctk.CTk):
         self.btn_new = ctk.CTkButton(self.header_frame, text="+", command=self.open_new_book, **main_btn_style)
         self.btn_new.grid(row=0, column=2, padx=5, pady=10)
 
+        self.btn_select = ctk.CTkButton(self.header_frame, text="☑", command=self.toggle_select_mode, **main_btn_style)
+        self.btn_select.grid(row=0, column=3, padx=5, pady=10)
+
         self.btn_export = ctk.CTkButton(self.header_frame, text="📊", command=self.export_to_excel, **main_btn_style)
-        self.btn_export.grid(row=0, column=3, padx=(5, 20), pady=10)
+        self.btn_export.grid(row=0, column=4, padx=(5, 20), pady=10)
+
+        # Every database call of the GUI goes through this thread
+        self.db = DBWorker(self)
+        self.db.on_pending_change = self.on_db_pending
+        self._busy_after = None
+
+        self.facet_bar = FacetBar(self.header_frame, self.db, self.on_filters_changed)
+        self.facet_bar.grid(row=1, column=0, columnspan=5, sticky="ew", padx=20, pady=(0, 10))
+
+        # Multi-select actions, shown by the ☑ button
+        self.bulk_bar = ctk.CTkFrame(self.header_frame, fg_color="transparent")
+        self.lbl_selected = ctk.CTkLabel(self.bulk_bar, text="", font=("Arial", 14))
+        self.lbl_selected.pack(side="left", padx=(0, 10))
+        for text, command in (("Fine", self.toggle_select_mode), ("Elimina", self.bulk_delete),
+                              ("Modifica", self.bulk_edit), ("Seleziona tutti", lambda: self.book_list.select_all())):
+            ctk.CTkButton(self.bulk_bar, text=text, width=100, command=command).pack(side="right", padx=(5, 0))
 
         # --- Content Area ---
         self.content_frame = ctk.CTkFrame(self)
@@ -65,20 +430,77 @@ class App(ctk.CTk):
         self.content_frame.grid_rowconfigure(0, weight=1)
 
         # Book List - Removed label for a cleaner look
-        self.scrollable_list = ctk.CTkScrollableFrame(self.content_frame)
-        self.scrollable_list.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
-        self.scrollable_list.grid_columnconfigure(0, weight=1)
+        self.book_list = VirtualBookList(self.content_frame, self.open_detail, self.load_more)
+        self.book_list.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
+        self.book_list.on_selection_change = lambda count: self.lbl_selected.configure(text=f"{count} selezionati")
+
+        # Shown while a database call takes long enough to notice (see on_db_pending)
+        self.busy_bar = ctk.CTkProgressBar(self, mode="indeterminate", height=4)
 
         # Pagination State
         self.current_query = ""
-        self.current_offset = 0
+        self.next_cursor = None
         self.is_show_all = False
+        self.filters = ()
         self.items_per_page = 50
-        self.load_more_btn = None
+        self.list_generation = 0 # Bumped by reset_list: pages still loading for an old list are dropped
+        self.loading_page = False
         self.detail_frame = None
+        self.welcome_logo = None
+        self.search_scheduler = SearchScheduler(
+            self, self.db, lambda q: self.fetch_page(q, None, 50),
+            self.on_search_results, on_error=self.show_db_error)
 
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.diagnostics = None
+        if perf.ENABLED: # Hidden panel, only for profiling sessions
+            self.bind("<Control-Shift-D>", lambda e: self.show_diagnostics())
+        self.facet_bar.refresh()
         self.show_welcome()
 
+    def on_close(self):
+        self.db.stop() # Waits for a save still in the queue
+        if perf.ENABLED:
+            try:
+                perf.dump(extra=self.diagnostics_extra())
+            except OSError:
+                pass # Not worth blocking the exit for
+        database.close_all_connections()
+        self.destroy()
+
+    def diagnostics_extra(self):
+        return {"cache": database.cache_stats(), "busy": database.busy_stats(), "pending_db_calls": self.db.pending}
+
+    def show_diagnostics(self):
+        if self.diagnostics is not None and self.diagnostics.winfo_exists():
+            self.diagnostics.focus()
+            return
+        self.diagnostics = DiagnosticsWindow(self, self.diagnostics_extra)
+
+    def show_db_error(self, error):
+        messagebox.showerror("Errore", str(error))
+
+    def on_db_pending(self, count):
+        if count:
+            # Only for calls slower than a blink, so that quick ones don't flicker
+            if self._busy_after is None and not self.busy_bar.winfo_ismapped():
+                self._busy_after = self.after(200, self._show_busy)
+            return
+        if self._busy_after is not None:
+            self.after_cancel(self._busy_after)
+            self._busy_after = None
+        if self.busy_bar.winfo_ismapped():
+            self.busy_bar.stop()
+            self.busy_bar.grid_forget()
+            self.configure(cursor="")
+
+    def _show_busy(self):
+        self._busy_after = None
+        if self.db.pending:
+            self.busy_bar.grid(row=2, column=0, sticky="ew", padx=20, pady=(0, 10))
+            self.busy_bar.start()
+            self.configure(cursor="watch")
+
     def set_app_icon(self, window=None):
         if window is None: window = self
         try:
@@ -91,183 +513,375 @@ class App(ctk.CTk):
             pass
 
     def show_welcome(self):
-        for widget in self.scrollable_list.winfo_children():
-            widget.destroy()
+        self.book_list.show_message()
+        self.reset_list() # A page still loading must not draw over the welcome screen
         
         try:
             path = resource_path("app_icon.png")
             if os.path.exists(path):
-                # Use CTkImage for better compatibility and scaling
-                pil_img = Image.open(path)
-                # Adjusted logo to 350x350 for an even more refined look
-                self.welcome_logo = ctk.CTkImage(light_image=pil_img, dark_image=pil_img, size=(300, 300))
-                lbl_logo = ctk.CTkLabel(self.scrollable_list, image=self.welcome_logo, text="")
-                lbl_logo.pack(pady=70) # Adjusted padding
+                if self.welcome_logo is None:
+                    from PIL import Image
+                    # Use CTkImage for better compatibility and scaling
+                    pil_img = Image.open(path)
+                    # Adjusted logo to 350x350 for an even more refined look
+                    self.welcome_logo = ctk.CTkImage(light_image=pil_img, dark_image=pil_img, size=(300, 300))
+                self.book_list.show_message(image=self.welcome_logo, pady=70) # Adjusted padding
         except Exception as e:
             print(f"Logo error: {e}")
 
     def load_books(self, query="", show_all=False, append=False):
         if not append:
-            for widget in self.scrollable_list.winfo_children():
-                widget.destroy()
-            self.current_offset = 0
-            self.current_query = query
-            self.is_show_all = show_all
-            if self.load_more_btn:
-                self.load_more_btn.destroy()
-                self.load_more_btn = None
-
-        if self.current_query:
-            books = database.search_books(self.current_query, limit=self.items_per_page, offset=self.current_offset)
-        elif self.is_show_all:
-            books = database.get_all_books(limit=self.items_per_page, offset=self.current_offset)
-        else:
+            self.search_scheduler.cancel()
+            self.reset_list(query, show_all)
+
+        if not (self.current_query or self.is_show_all):
+            if not append:
+                self.book_list.show_message() # Nothing to reload: don't leave stale books on screen
             return
+        if append and self.loading_page:
+            return
+        self.loading_page = True
+        generation = self.list_generation
+        self.db.submit(self.fetch_page, self.current_query, self.next_cursor, self.items_per_page,
+                       on_done=lambda page: self.on_page_loaded(generation, page, append),
+                       on_error=lambda error: self.on_page_loaded(generation, None, append, error))
 
-        if not books and not append:
-            lbl = ctk.CTkLabel(self.scrollable_list, text="Nessun libro trovato.", font=("Arial", 14))
-            lbl.pack(pady=20)
+    def on_page_loaded(self, generation, page, append, error=None):
+        if generation != self.list_generation:
+            return # The list was reset meanwhile
+        self.loading_page = False
+        if error is not None:
+            self.show_db_error(error)
             return
+        self.show_books(*page, append)
 
-        for book in books:
-            self.create_book_card(book)
-        
-        if len(books) == self.items_per_page:
-             self.items_per_page = 10
-             if self.load_more_btn: self.load_more_btn.destroy()
-             self.load_more_btn = ctk.CTkButton(self.scrollable_list, text="Carica Altri (+10)", 
-                                              command=self.load_more, fg_color="gray30")
-             self.load_more_btn.pack(pady=20)
+    def fetch_page(self, query, after, limit):
+        """Runs on the DB worker."""
+        filters = self.filters # A tuple, replaced rather than modified: safe to read from the worker
+        books, next_cursor = database.get_books_page(query, after=after, limit=limit, filters=filters)
+        if query and not books and after is None:
+            # Nothing matches as typed: show the closest books (typos, missing accents)
+            books = database.fuzzy_search_books(query, limit=limit, filters=filters)
+        return books, next_cursor
+
+    def on_filters_changed(self, filters):
+        self.filters = tuple(filters.items())
+        query = self.search_entry.get()
+        if query or filters:
+            self.load_books(query, show_all=not query)
         else:
-             if self.load_more_btn: self.load_more_btn.destroy()
+            self.show_welcome()
 
-    def create_book_card(self, book):
-        card = ctk.CTkFrame(self.scrollable_list, fg_color=("gray90", "gray20"))
-        card.pack(fill="x", pady=5, padx=5)
-        
-        # Text container for vertical stacking
-        text_frame = ctk.CTkFrame(card, fg_color="transparent")
-        text_frame.pack(side="left", padx=10, pady=10, fill="both", expand=True)
+    def reset_list(self, query="", show_all=False):
+        self.list_generation += 1
+        self.loading_page = False
+        self.next_cursor = None
+        self.current_query = query
+        self.is_show_all = show_all
 
-        title_val = book['title'] if book['title'] else "Senza Titolo"
-        year_val = f" ({book['year']})" if book['year'] else ""
-        lbl_title = ctk.CTkLabel(text_frame, text=f"{title_val}{year_val}", font=("Arial", 16, "bold"), anchor="w")
-        lbl_title.pack(side="top", anchor="w")
-        
-        author_val = book['author'] if book['author'] else "Autore sconosciuto"
-        lbl_author = ctk.CTkLabel(text_frame, text=author_val, font=("Arial", 12, "italic"), text_color="gray", anchor="w")
-        lbl_author.pack(side="top", anchor="w")
-        
-        # Minimalist View Button
-        btn_view = ctk.CTkButton(card, text="📖", width=40, height=40, font=("Arial", 20),
-                                fg_color="transparent", border_width=1, border_color="white",
-                                command=lambda b=book: self.open_detail(b))
-        btn_view.pack(side="right", padx=10, pady=10)
+    @perf.timed("ui.show_books")
+    def show_books(self, books, next_cursor, append=False):
+        self.next_cursor = next_cursor
+        if not books and not append:
+            self.book_list.show_message(text="Nessun libro trovato.")
+            return
+
+        if self.next_cursor is not None:
+            self.items_per_page = 10
+        self.book_list.show_books(books, has_more=self.next_cursor is not None, append=append)
 
     def load_more(self):
-        self.current_offset += 50 if self.current_offset == 0 else 10
         self.load_books(append=True)
 
     def on_search(self, event):
         query = self.search_entry.get()
         if not query:
+            self.search_scheduler.cancel()
+            if self.filters:
+                self.load_books(show_all=True)
+                return
             self.show_welcome()
             self.focus() # Remove focus from entry to hide cursor
             return
 
         if len(query) > 2:
-            self.items_per_page = 50
-            self.load_books(query)
-        elif len(query) == 0:
-            self.show_welcome()
+            if query == self.current_query:
+                # e.g. arrow keys: results on screen are already for this text
+                self.search_scheduler.cancel()
+                return
+            self.search_scheduler.schedule(query)
+        else:
+            self.search_scheduler.cancel()
 
+    def on_search_results(self, query, page):
+        books, next_cursor = page
+        self.items_per_page = 50
+        self.reset_list(query)
+        self.show_books(books, next_cursor)
+
+    def toggle_select_mode(self):
+        enabled = not self.book_list.select_mode
+        self.book_list.set_select_mode(enabled)
+        if enabled:
+            self.bulk_bar.grid(row=2, column=0, columnspan=5, sticky="ew", padx=20, pady=(0, 10))
+        else:
+            self.bulk_bar.grid_forget()
+
+    def bulk_edit(self):
+        if not self.book_list.selected:
+            messagebox.showwarning("Modifica", "Nessun libro selezionato.")
+            return
+        BulkEditDialog(self, self.db, list(self.book_list.selected), self.after_bulk_change)
+
+    def bulk_delete(self):
+        ids = list(self.book_list.selected)
+        if not ids:
+            messagebox.showwarning("Elimina", "Nessun libro selezionato.")
+            return
+        if messagebox.askyesno("Conferma", f"Eliminare {len(ids)} libri?"):
+            self.db.submit(database.delete_books, ids, on_done=lambda count: self.after_bulk_change(),
+                           on_error=self.show_db_error)
+
+    def after_bulk_change(self):
+        self.book_list.clear_selection()
+        self.facet_bar.refresh()
+        if self.current_query or self.is_show_all:
+            self.load_books(self.current_query, show_all=self.is_show_all)
+        else:
+            self.book_list.refresh()
+
+    @perf.timed("ui.open_detail")
     def open_detail(self, book):
         if self.detail_frame: self.detail_frame.destroy()
         self.header_frame.grid_forget()
-        self.scrollable_list.grid_forget()
-        self.detail_frame = BookDetailFrame(self.content_frame, book, self.back_to_list, delete_callback=self.on_book_deleted)
+        self.book_list.grid_forget()
+        self.detail_frame = BookDetailFrame(self.content_frame, book, self.db, self.back_to_list, delete_callback=self.on_book_deleted)
         self.detail_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
 
     def open_new_book(self):
         if self.detail_frame: self.detail_frame.destroy()
         self.header_frame.grid_forget()
-        self.scrollable_list.grid_forget()
-        self.detail_frame = BookDetailFrame(self.content_frame, None, self.back_to_list, is_new=True, delete_callback=self.on_book_deleted)
+        self.book_list.grid_forget()
+        self.detail_frame = BookDetailFrame(self.content_frame, None, self.db, self.back_to_list, is_new=True, delete_callback=self.on_book_deleted)
         self.detail_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
 
     def on_book_deleted(self):
         self.back_to_list()
-        self.load_books(self.search_entry.get())
+        self.load_books(self.current_query, show_all=self.is_show_all)
 
     def back_to_list(self):
         if self.detail_frame:
             self.detail_frame.destroy()
             self.detail_frame = None
         self.header_frame.grid(row=0, column=0, sticky="ew", padx=20, pady=20)
-        self.scrollable_list.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
+        self.book_list.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
+        self.facet_bar.refresh() # Counts may have changed in the detail view
 
     def export_to_excel(self):
+        self.db.submit(database.count_books, on_done=self.ask_export_path,
+                       on_error=lambda e: messagebox.showerror("Errore Esportazione", str(e)))
+
+    def ask_export_path(self, count):
         try:
-            books_dict = database.get_all_books_sorted()
-            if not books_dict:
+            if count == 0:
                 messagebox.showwarning("Esportazione", "Il database è vuoto.")
                 return
 
-            df = pd.DataFrame(books_dict)
-            
-            # Map columns to user-friendly names
-            columns_map = {
-                'title': 'Titolo',
-                'author': 'Autore',
-                'genre': 'Genere',
-                'year': 'Anno',
-                'publisher': 'Editore',
-                'location': 'Posizione',
-                'language': 'Lingua',
-                'is_loaned': 'In Prestito',
-                'loaned_to': 'Prestato a'
-            }
-            
-            # Reorder and filter if needed (removing 'id')
-            df_export = df[[c for c in columns_map.keys() if c in df.columns]].rename(columns=columns_map)
-            
-            # Convert Boolean/Int to friendly string
-            if 'In Prestito' in df_export.columns:
-                df_export['In Prestito'] = df_export['In Prestito'].apply(lambda x: 'Sì' if x == 1 else 'No')
-
             file_path = filedialog.asksaveasfilename(
                 defaultextension=".xlsx",
-                filetypes=[("Excel files", "*.xlsx")],
+                filetypes=[("Excel files", "*.xlsx"), ("CSV", "*.csv"), ("TSV", "*.tsv")],
                 title="Salva Esportazione Biblioteca",
                 initialfile="Esportazione_Biblioteca.xlsx"
             )
 
             if file_path:
-                df_export.to_excel(file_path, index=False, engine='openpyxl')
-                messagebox.showinfo("Successo", f"Database esportato correttamente in:\n{file_path}")
+                ExportDialog(self, file_path)
         except Exception as e:
             messagebox.showerror("Errore Esportazione", str(e))
 
+class BulkEditDialog(ctk.CTkToplevel):
+    """Sets the filled-in fields on all the selected books at once (database.update_books)."""
+    FIELDS = [("Autore", "author"), ("Genere", "genre"), ("Anno", "year"), ("Editore", "publisher"),
+              ("Posizione", "location"), ("Lingua", "language")]
+
+    def __init__(self, master, worker, book_ids, done_callback):
+        super().__init__(master)
+        self.worker = worker
+        self.book_ids = book_ids
+        self.done_callback = done_callback
+        self.title("Modifica multipla")
+        self.geometry("420x380")
+        self.resizable(False, False)
+        self.transient(master)
+        self.grid_columnconfigure(1, weight=1)
+
+        ctk.CTkLabel(self, text=f"{len(book_ids)} libri: i campi vuoti restano invariati",
+                     font=("Arial", 13)).grid(row=0, column=0, columnspan=2, padx=20, pady=(15, 10), sticky="w")
+        self.entries = {}
+        for row, (label_text, key) in enumerate(self.FIELDS, start=1):
+            ctk.CTkLabel(self, text=label_text + ":", font=("Arial", 14, "bold")).grid(row=row, column=0, sticky="w", padx=20, pady=5)
+            if key == "year":
+                entry = ctk.CTkEntry(self, font=("Arial", 14))
+            else:
+                entry = AutocompleteEntry(self, suggestions_callback=lambda text, k=key: autocomplete.get_suggestions(k, text, limit=5), worker=worker, font=("Arial", 14))
+            entry.grid(row=row, column=1, sticky="ew", padx=20, pady=5)
+            self.entries[key] = entry
+
+        buttons = ctk.CTkFrame(self, fg_color="transparent")
+        buttons.grid(row=len(self.FIELDS) + 1, column=0, columnspan=2, pady=15)
+        self.btn_apply = ctk.CTkButton(buttons, text="Applica", command=self.apply)
+        self.btn_apply.pack(side="left", padx=5)
+        ctk.CTkButton(buttons, text="Annulla", fg_color="gray30", command=self.destroy).pack(side="left", padx=5)
+        self.after(100, self.grab_set) # Modal; delayed until the window is visible
+
+    def apply(self):
+        changes = {key: entry.get().strip() for key, entry in self.entries.items() if entry.get().strip()}
+        if not changes:
+            self.destroy()
+            return
+        self.btn_apply.configure(state="disabled")
+        self.worker.submit(database.update_books, self.book_ids, changes, on_done=self.on_applied, on_error=self.on_error)
+
+    def on_applied(self, count):
+        self.destroy()
+        messagebox.showinfo("Successo", f"{count} libri aggiornati.")
+        self.done_callback()
+
+    def on_error(self, error):
+        self.btn_apply.configure(state="normal")
+        messagebox.showerror("Errore", str(error), parent=self)
+
+class ExportDialog(ctk.CTkToplevel):
+    """Runs exporter.export_books on a background thread, showing progress and a cancel button."""
+    def __init__(self, master, path):
+        super().__init__(master)
+        self.title("Esportazione")
+        self.geometry("360x150")
+        self.resizable(False, False)
+        self.transient(master)
+        self.path = path
+        self.cancel_event = threading.Event()
+        self.events = queue.Queue() # Filled by the worker thread, drained by _poll on the Tk loop
+
+        self.lbl_status = ctk.CTkLabel(self, text="Esportazione in corso...", font=("Arial", 14))
+        self.lbl_status.pack(pady=(20, 10))
+        self.progress = ctk.CTkProgressBar(self, width=300)
+        self.progress.set(0)
+        self.progress.pack()
+        self.btn_cancel = ctk.CTkButton(self, text="Annulla", command=self.cancel, fg_color="gray30")
+        self.btn_cancel.pack(pady=15)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
+        threading.Thread(target=self.run_export, daemon=True).start()
+        self.after(100, self._poll)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.btn_cancel.configure(state="disabled")
+        self.lbl_status.configure(text="Annullamento...")
+
+    def run_export(self):
+        try:
+            written = exporter.export_books(
+                self.path, cancel_event=self.cancel_event,
+                progress=lambda done, total: self.events.put(("progress", done, total)))
+            self.events.put(("done", written))
+        except Exception as e:
+            self.events.put(("error", e))
+        finally:
+            database.close_connection() # This thread ends here: don't keep its connection open
+
+    def _poll(self):
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                _, done, total = event
+                if not self.cancel_event.is_set():
+                    self.progress.set(done / total if total else 1)
+                    self.lbl_status.configure(text=f"Esportati {done} di {total} libri...")
+                continue
+
+            master = self.master
+            self.destroy()
+            if event[0] == "error":
+                messagebox.showerror("Errore Esportazione", str(event[1]), parent=master)
+            elif event[1] is not None:
+                messagebox.showinfo("Successo", f"Database esportato correttamente in:\n{self.path}", parent=master)
+            return
+        self.after(100, self._poll)
+
+class DiagnosticsWindow(ctk.CTkToplevel):
+    """perf timings and counters of this session (Ctrl+Shift+D with LIBRARY_PERF=1 or --perf)."""
+    REFRESH_MS = 1000
+
+    def __init__(self, master, extra_callback):
+        super().__init__(master)
+        self.title("Diagnostica")
+        self.geometry("760x480")
+        self.extra_callback = extra_callback
+
+        self.text = ctk.CTkTextbox(self, font=("Courier New", 12), wrap="none")
+        self.text.pack(fill="both", expand=True, padx=10, pady=(10, 0))
+        buttons = ctk.CTkFrame(self, fg_color="transparent")
+        buttons.pack(fill="x", padx=10, pady=10)
+        ctk.CTkButton(buttons, text="Azzera", width=100, command=self.reset).pack(side="left")
+        ctk.CTkButton(buttons, text="Salva JSON", width=100, command=self.save).pack(side="right")
+        self.update_text()
+
+    def update_text(self):
+        extra = self.extra_callback()
+        cache = extra["cache"]
+        lines = [perf.format_table(), "",
+                 f"cache: {cache['hits']} hit, {cache['misses']} miss, {cache['entries']} voci, {cache['rows']} righe",
+                 f"lock: {extra['busy']['retries']} tentativi ripetuti, {extra['busy']['failures']} falliti",
+                 f"chiamate in coda: {extra['pending_db_calls']}"]
+        self.text.configure(state="normal")
+        self.text.delete("1.0", "end")
+        self.text.insert("1.0", "\n".join(lines))
+        self.text.configure(state="disabled")
+        self._after = self.after(self.REFRESH_MS, self.update_text)
+
+    def destroy(self):
+        self.after_cancel(self._after)
+        super().destroy()
+
+    def reset(self):
+        perf.reset()
+
+    def save(self):
+        path = filedialog.asksaveasfilename(parent=self, defaultextension=".json", initialfile=perf.DUMP_FILE,
+                                            filetypes=[("JSON", "*.json")])
+        if path:
+            perf.dump(path, extra=self.extra_callback())
+
 class AutocompleteEntry(ctk.CTkEntry):
-    def __init__(self, master, suggestions_callback, **kwargs):
+    """Entry with a suggestions dropdown; suggestions_callback(text) runs on the DB worker."""
+    def __init__(self, master, suggestions_callback, worker, **kwargs):
         super().__init__(master, **kwargs)
         self.suggestions_callback = suggestions_callback
+        self.worker = worker
         self.dropdown = None
         self.bind("<KeyRelease>", self.on_key_release)
         self.bind("<FocusOut>", self.on_focus_out)
         self.bind("<FocusIn>", self.on_key_release)
 
     def on_key_release(self, event=None):
-        val = self.get().lower()
+        val = self.get()
         if not val:
             self.hide_dropdown()
             return
         
-        all_suggestions = self.suggestions_callback()
-        filtered = [s for s in all_suggestions if val in str(s).lower()]
-        
+        self.worker.submit(self.suggestions_callback, val,
+                           on_done=lambda filtered: self.on_suggestions(val, filtered))
+
+    def on_suggestions(self, val, filtered):
+        if not self.winfo_exists() or self.get() != val:
+            return # Typed on (or closed) while the lookup ran
         if filtered:
-            self.show_dropdown(filtered[:5]) # Show top 5
+            self.show_dropdown(filtered)
         else:
             self.hide_dropdown()
 
@@ -305,9 +919,11 @@ class AutocompleteEntry(ctk.CTkEntry):
         self.after(200, self.hide_dropdown)
 
 class BookDetailFrame(ctk.CTkFrame):
-    def __init__(self, master, book, back_callback, is_new=False, delete_callback=None):
+    def __init__(self, master, book, worker, back_callback, is_new=False, delete_callback=None):
         super().__init__(master)
-        self.book = dict(book) if book else {}
+        self.worker = worker
+        # Own copy: the Book in the list is shared with the result cache
+        self.book = book.copy() if book else database.Book()
         self.back_callback = back_callback
         self.delete_callback = delete_callback
         self.is_new = is_new
@@ -349,7 +965,7 @@ class BookDetailFrame(ctk.CTkFrame):
             self.btn_delete.pack(side="left", padx=5)
             
             # Loan Button
-            loan_val = self.book.get('is_loaned', 0)
+            loan_val = self.book.is_loaned
             self.btn_loan_action = ctk.CTkButton(self.icons_frame, text="🚪➔" if not loan_val else "🚪⇠", 
                                                 command=self.handle_loan, **btn_style)
             self.btn_loan_action.pack(side="left", padx=5)
@@ -366,14 +982,14 @@ class BookDetailFrame(ctk.CTkFrame):
         current_row = 1
         for label_text, key in self.fields:
             ctk.CTkLabel(self, text=label_text + ":", font=("Arial", 14, "bold")).grid(row=current_row, column=0, sticky="w", padx=20, pady=5)
-            val = self.book.get(key, "")
+            val = getattr(self.book, key)
             
             lbl_val = ctk.CTkLabel(self, text=str(val if val else ""), font=("Arial", 14), anchor="w")
             self.labels[key] = lbl_val
             
             # Autocomplete for metadata fields
             if key != "title" and key != "year":
-                entry = AutocompleteEntry(self, suggestions_callback=lambda k=key: database.get_unique_values(k), font=("Arial", 14))
+                entry = AutocompleteEntry(self, suggestions_callback=lambda text, k=key: autocomplete.get_suggestions(k, text, limit=5), worker=worker, font=("Arial", 14))
             else:
                 entry = ctk.CTkEntry(self, font=("Arial", 14))
             
@@ -388,8 +1004,8 @@ class BookDetailFrame(ctk.CTkFrame):
         if not self.is_new:
             ctk.CTkLabel(self, text="Stato:", font=("Arial", 14, "bold")).grid(row=current_row, column=0, sticky="w", padx=20, pady=15)
             
-            loan_val = self.book.get('is_loaned', 0)
-            loaned_to = self.book.get('loaned_to', "")
+            loan_val = self.book.is_loaned
+            loaned_to = self.book.loaned_to or ""
             status_text = "Disponibile" if not loan_val else f"In Prestito ({loaned_to})"
             
             self.lbl_loan_status = ctk.CTkLabel(self, text=status_text, font=("Arial", 14), anchor="w")
@@ -457,42 +1073,63 @@ class BookDetailFrame(ctk.CTkFrame):
 
     def save_data(self):
         data = {k: self.entries[k].get() for _, k in self.fields}
-        try:
-            if self.is_new:
-                database.add_book(**data)
-                messagebox.showinfo("Successo", "Libro aggiunto!")
-                self.back_callback()
-            else:
-                data['is_loaned'] = self.book['is_loaned']
-                data['loaned_to'] = self.book['loaned_to']
-                database.update_book(self.book['id'], **data)
-                messagebox.showinfo("Successo", "Salvato!")
-                self.book.update(data)
-                for _, k in self.fields: self.labels[k].configure(text=str(data[k]))
-                self.original_data = data.copy()
-                self.toggle_edit()
-        except Exception as e: messagebox.showerror("Errore", str(e))
+        self.btn_save.configure(state="disabled") # Until the worker is done: no double saves
+        if self.is_new:
+            self.worker.submit(database.add_book, **data, on_done=lambda _: self.on_added(), on_error=self.on_save_error)
+        else:
+            data['is_loaned'] = self.book.is_loaned
+            data['loaned_to'] = self.book.loaned_to
+            self.worker.submit(database.update_book, self.book.id, **data,
+                               on_done=lambda _: self.on_updated(data), on_error=self.on_save_error)
+
+    def on_added(self):
+        messagebox.showinfo("Successo", "Libro aggiunto!")
+        self.back_callback()
+
+    def on_updated(self, data):
+        self.btn_save.configure(state="normal")
+        messagebox.showinfo("Successo", "Salvato!")
+        for k, v in data.items(): setattr(self.book, k, v)
+        for _, k in self.fields: self.labels[k].configure(text=str(data[k]))
+        self.original_data = data.copy()
+        self.toggle_edit()
+
+    def on_save_error(self, error):
+        self.btn_save.configure(state="normal")
+        messagebox.showerror("Errore", str(error))
 
     def confirm_delete(self):
         if messagebox.askyesno("Conferma", "Eliminare il libro?"):
-            database.delete_book(self.book['id'])
-            if self.delete_callback: self.delete_callback()
+            self.worker.submit(database.delete_book, self.book.id,
+                               on_done=lambda _: self.delete_callback and self.delete_callback(),
+                               on_error=lambda e: messagebox.showerror("Errore", str(e)))
 
     def handle_loan(self):
-        if not self.book['is_loaned']:
+        if not self.book.is_loaned:
             name = ctk.CTkInputDialog(text="A chi presti il libro?", title="Prestito").get_input()
             if name:
-                database.toggle_loan_status(self.book['id'], 0, name)
-                self.book['is_loaned'] = 1; self.book['loaned_to'] = name
+                self.worker.submit(database.toggle_loan_status, self.book.id, 0, name,
+                                   on_done=lambda _: self.on_loan_changed(1, name),
+                                   on_error=lambda e: messagebox.showerror("Errore", str(e)))
         else:
             if messagebox.askyesno("Reso", "Libro restituito?"):
-                database.toggle_loan_status(self.book['id'], 1)
-                self.book['is_loaned'] = 0; self.book['loaned_to'] = ""
-        
-        status = "Disponibile" if not self.book['is_loaned'] else f"In Prestito ({self.book['loaned_to']})"
+                self.worker.submit(database.toggle_loan_status, self.book.id, 1,
+                                   on_done=lambda _: self.on_loan_changed(0, ""),
+                                   on_error=lambda e: messagebox.showerror("Errore", str(e)))
+
+    def on_loan_changed(self, is_loaned, loaned_to):
+        self.book.is_loaned = is_loaned; self.book.loaned_to = loaned_to
+        status = "Disponibile" if not self.book.is_loaned else f"In Prestito ({self.book.loaned_to})"
         self.lbl_loan_status.configure(text=status)
-        self.btn_loan_action.configure(text="🚪➔" if not self.book['is_loaned'] else "🚪⇠")
+        self.btn_loan_action.configure(text="🚪➔" if not self.book.is_loaned else "🚪⇠")
 
 if __name__ == "__main__":
+    if "--perf" in sys.argv:
+        perf.enable()
+    database.create_table()
+    mark_startup("schema database")
     app = App()
+    mark_startup("costruzione finestra")
+    # Idle callbacks run in order: this one comes after the first redraw of the window
+    app.after_idle(lambda: (mark_startup("prima visualizzazione"), report_startup()))
     app.mainloop()
@@ -0,0 +1,157 @@
+"""
+Lightweight timings and counters for the hot paths (SQL, widgets, autocomplete, export),
+to see where time goes in a real session without a profiler. Off unless LIBRARY_PERF=1
+or main.py --perf; when off, timed() and count() cost one flag check.
+
+    @perf.timed("db.search", rows=len)
+    def search(...): ...
+
+    with perf.measure("ui.show_books"):
+        ...
+    perf.count("ui.book_card.created")
+"""
+import bisect
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("LIBRARY_PERF") == "1"
+DUMP_FILE = os.environ.get("LIBRARY_PERF_FILE", "library_perf.json")
+
+# Upper bounds (ms) of the histogram buckets; the last bucket takes everything slower
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+BUCKET_LABELS = [f"<={bound}" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+
+class Timing:
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms, rows=None):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if rows is not None:
+            self.rows += rows
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding that fraction of the calls (None if the last one)."""
+        target = self.count * fraction
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= target:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 3),
+            "rows": self.rows,
+            "histogram": {label: n for label, n in zip(BUCKET_LABELS, self.buckets) if n},
+        }
+
+_lock = threading.Lock() # Updated from the Tk thread and the DB worker at once
+_timings = {}
+_counters = {}
+_started = time.time()
+
+def enable(dump_file=None):
+    global ENABLED, DUMP_FILE
+    ENABLED = True
+    if dump_file:
+        DUMP_FILE = dump_file
+
+def record(name, ms, rows=None):
+    if not ENABLED:
+        return
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = Timing()
+        timing.add(ms, rows)
+
+def count(name, n=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+@contextlib.contextmanager
+def measure(name):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+def timed(name, rows=None):
+    """Decorator: records every call of the function under name. rows(result) -> rows returned."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            record(name, (time.perf_counter() - start) * 1000, rows(result) if rows else None)
+            return result
+        return wrapper
+    return decorator
+
+def snapshot():
+    """All timings and counters so far, as plain dicts (slowest total first)."""
+    with _lock:
+        timings = sorted(_timings.items(), key=lambda item: item[1].total_ms, reverse=True)
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_started)),
+            "seconds": round(time.time() - _started, 1),
+            "timings": {name: timing.as_dict() for name, timing in timings},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+def format_table(data=None):
+    """snapshot() as fixed-width text, for the diagnostics panel."""
+    data = data or snapshot()
+    lines = [f"{'operazione':<36}{'n':>7}{'media ms':>10}{'p95 ms':>9}{'max ms':>10}{'righe':>9}"]
+    for name, t in data["timings"].items():
+        p95 = t["p95_ms"] if t["p95_ms"] is not None else f">{BUCKETS_MS[-1]}"
+        lines.append(f"{name:<36}{t['count']:>7}{t['mean_ms']:>10.2f}{p95:>9}{t['max_ms']:>10.1f}{t['rows']:>9}")
+    if data["counters"]:
+        lines.append("")
+        lines.extend(f"{name:<36}{value:>7}" for name, value in data["counters"].items())
+    return "\n".join(lines)
+
+def reset():
+    global _started
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        _started = time.time()
+
+def dump(path=None, extra=None):
+    """Writes snapshot() (plus extra, e.g. database.cache_stats()) as JSON; returns the path."""
+    path = path or DUMP_FILE
+    data = snapshot()
+    if extra:
+        data.update(extra)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    return path
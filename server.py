@@ -0,0 +1,359 @@
+"""
+Optional local HTTP/JSON server over database.py, so that scanners, scripts and web
+pages on the home network can use the catalog while the app is open:
+
+    python server.py                      # this PC only (127.0.0.1:8765)
+    python server.py --host 0.0.0.0       # whole LAN: there is no login, trusted networks only
+
+GET    /books?q=&after=&limit=&filter=genre:Giallo   page of books (filter repeatable)
+GET    /books/fuzzy?q=&limit=                        closest books to a misspelled query
+GET    /books/<id>                                   one book
+POST   /books                                        new book (JSON fields of database.Book)
+PUT    /books/<id>                                   change the fields given
+DELETE /books/<id>
+POST   /books/<id>/loan   {"loaned_to": "..."}       lend
+POST   /books/<id>/return
+GET    /books/<id>/loans                             loan history of a book
+GET    /loans?borrower=&overdue=<days>               open loans (or of a borrower / overdue)
+GET    /facets?filter=&limit=                        book counts per genre, language...
+
+Reads run on a small pool of threads, each with its own connection (WAL lets them run
+alongside a write); every write goes through one thread, so requests never compete
+with each other for SQLite's single write lock.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import re
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import database
+
+HOST = "127.0.0.1"
+PORT = 8765
+READERS = 4
+MAX_PAGE = 200
+MAX_BODY = 1024 * 1024
+MAX_ID = 2 ** 63 - 1 # SQLite INTEGER; a larger value makes sqlite3 raise OverflowError
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} non valido: {value!r}")
+
+def _book_id(text):
+    """Book id from the URL path: one SQLite can't even store is simply not there."""
+    book_id = int(text)
+    if book_id > MAX_ID:
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"Libro {text} non trovato")
+    return book_id
+
+def _filters(params):
+    """filter=column:value parameters -> get_books_page() filters (sorted: one cache entry per set)."""
+    filters = []
+    for item in params.get("filter", []):
+        column, sep, value = item.partition(":")
+        if not sep:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Filtro non valido: {item!r} (colonna:valore)")
+        filters.append((column, value))
+    return tuple(sorted(filters))
+
+def _limit(params, default=50):
+    return max(1, min(MAX_PAGE, _int(params.get("limit", [default])[0], "limit")))
+
+def encode_cursor(cursor):
+    return json.dumps(cursor, separators=(",", ":")) if cursor else None
+
+def decode_cursor(text):
+    """Inverse of encode_cursor(); back to tuples, which get_books_page() uses as cache keys."""
+    if not text:
+        return None
+    try:
+        kind, (key, book_id) = json.loads(text)
+    except (ValueError, TypeError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "after non valido")
+    # Titles imported from Excel can be numbers; bool is an int subclass but never a key
+    valid_key = key is None or (isinstance(key, (str, int, float)) and not isinstance(key, bool))
+    if kind not in ("title", "rank") or not valid_key or not isinstance(book_id, int) or isinstance(book_id, bool):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "after non valido")
+    return kind, (key, book_id)
+
+def _book_or_404(book_id):
+    book = database.get_book(book_id)
+    if book is None:
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"Libro {book_id} non trovato")
+    return book
+
+def check_fields(fields):
+    """
+    Validates JSON book fields before they reach the database: is_loaned drives the facet
+    counts and the loan history triggers, so only 0/1 is accepted. Returns the fields.
+    """
+    for name, value in fields.items():
+        if name == "is_loaned":
+            if isinstance(value, bool):
+                value = fields[name] = int(value)
+            if value not in (0, 1) or not isinstance(value, int):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "is_loaned deve essere 0 o 1")
+        elif name == "year":
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "year deve essere un numero intero o null")
+        elif value is not None and not isinstance(value, str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} deve essere un testo o null")
+    return fields
+
+# --- Writes: run on the writer thread, so read-modify-write steps can't interleave ---
+
+def _update(book_id, fields):
+    book = _book_or_404(book_id).copy() # Cached Books are shared
+    for name in fields:
+        if name == "id" or name not in database.BOOK_FIELDS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Campo non valido: {name}")
+    for name, value in check_fields(fields).items():
+        setattr(book, name, value)
+    database.update_book(*book.astuple())
+    return book
+
+def _lend(book_id, loaned_to):
+    book = _book_or_404(book_id)
+    if book.is_loaned:
+        if book.loaned_to == loaned_to:
+            return book # Same request repeated
+        raise HTTPError(HTTPStatus.CONFLICT, f"Libro già in prestito a {book.loaned_to}")
+    database.toggle_loan_status(book_id, 0, loaned_to)
+    return database.get_book(book_id)
+
+def _return(book_id):
+    if _book_or_404(book_id).is_loaned:
+        database.toggle_loan_status(book_id, 1)
+    return database.get_book(book_id)
+
+def _delete(book_id):
+    _book_or_404(book_id)
+    database.delete_book(book_id)
+
+class LibraryServer:
+    def __init__(self, readers=READERS):
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix="db-reader")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+        self.routes = [] # (method, compiled path, handler)
+        for method, path, handler in (
+            ("GET", r"/books", self.list_books),
+            ("GET", r"/books/fuzzy", self.fuzzy_books),
+            ("POST", r"/books", self.add_book),
+            ("GET", r"/books/(\d+)", self.get_book),
+            ("PUT", r"/books/(\d+)", self.update_book),
+            ("DELETE", r"/books/(\d+)", self.delete_book),
+            ("POST", r"/books/(\d+)/loan", self.lend_book),
+            ("POST", r"/books/(\d+)/return", self.return_book),
+            ("GET", r"/books/(\d+)/loans", self.book_loans),
+            ("GET", r"/loans", self.loans),
+            ("GET", r"/facets", self.facets),
+        ):
+            self.routes.append((method, re.compile(path + "/?"), handler))
+
+    async def read(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, functools.partial(fn, *args, **kwargs))
+
+    async def write(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, functools.partial(fn, *args, **kwargs))
+
+    # --- Handlers: (params, body, *path groups) -> (status, JSON-able result) ---
+
+    async def list_books(self, params, body):
+        after = decode_cursor(params.get("after", [None])[0])
+        books, cursor = await self.read(database.get_books_page, params.get("q", [""])[0].strip(), after,
+                                        _limit(params), _filters(params))
+        return HTTPStatus.OK, {"books": [b.as_dict() for b in books], "next": encode_cursor(cursor)}
+
+    async def fuzzy_books(self, params, body):
+        books = await self.read(database.fuzzy_search_books, params.get("q", [""])[0], _limit(params),
+                                filters=_filters(params))
+        return HTTPStatus.OK, {"books": [b.as_dict() for b in books]}
+
+    async def get_book(self, params, body, book_id):
+        return HTTPStatus.OK, (await self.read(_book_or_404, _book_id(book_id))).as_dict()
+
+    async def add_book(self, params, body):
+        unknown = set(body) - set(database.BOOK_FIELDS[1:])
+        if unknown:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Campi non validi: {', '.join(sorted(unknown))}")
+        if not body.get("title"):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "title obbligatorio")
+        book = database.Book(**check_fields(body))
+        book.id = await self.write(database.add_book, *book.astuple()[1:])
+        return HTTPStatus.CREATED, book.as_dict()
+
+    async def update_book(self, params, body, book_id):
+        return HTTPStatus.OK, (await self.write(_update, _book_id(book_id), body)).as_dict()
+
+    async def delete_book(self, params, body, book_id):
+        await self.write(_delete, _book_id(book_id))
+        return HTTPStatus.OK, {"deleted": int(book_id)}
+
+    async def lend_book(self, params, body, book_id):
+        if not body.get("loaned_to") or not isinstance(body["loaned_to"], str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "loaned_to obbligatorio")
+        return HTTPStatus.OK, (await self.write(_lend, _book_id(book_id), body["loaned_to"])).as_dict()
+
+    async def return_book(self, params, body, book_id):
+        return HTTPStatus.OK, (await self.write(_return, _book_id(book_id))).as_dict()
+
+    async def book_loans(self, params, body, book_id):
+        loans = await self.read(database.get_book_loans, _book_id(book_id))
+        return HTTPStatus.OK, {"loans": [loan.as_dict() for loan in loans]}
+
+    async def loans(self, params, body):
+        if "borrower" in params:
+            loans = await self.read(database.get_borrower_loans, params["borrower"][0],
+                                    open_only=params.get("open", ["0"])[0] == "1")
+        elif "overdue" in params:
+            loans = await self.read(database.get_overdue_loans, _int(params["overdue"][0] or database.LOAN_DAYS, "overdue"))
+        else:
+            loans = await self.read(database.get_current_loans)
+        return HTTPStatus.OK, {"loans": [loan.as_dict() for loan in loans]}
+
+    async def facets(self, params, body):
+        limit = _int(params["limit"][0], "limit") if "limit" in params else None
+        return HTTPStatus.OK, await self.read(database.get_facets, _filters(params), limit)
+
+    # --- HTTP ---
+
+    async def dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        allowed = False
+        for route_method, path, handler in self.routes:
+            match = path.fullmatch(url.path)
+            if match is None:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "JSON non valido")
+            if not isinstance(data, dict):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Atteso un oggetto JSON")
+            return await handler(params, data, *match.groups())
+        if allowed:
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} non ammesso su {url.path}")
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"{url.path} non trovato")
+
+    async def handle_connection(self, reader, writer):
+        """Serves one client; HTTP/1.1 keep-alive, so a client can send many requests."""
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                try:
+                    if method == "OPTIONS": # CORS preflight from a web page
+                        status, result = HTTPStatus.NO_CONTENT, None
+                    else:
+                        status, result = await self.dispatch(method, target, body)
+                except HTTPError as e:
+                    status, result = e.status, {"error": str(e)}
+                except ValueError as e: # e.g. an invalid filter column from database.py
+                    status, result = HTTPStatus.BAD_REQUEST, {"error": str(e)}
+                except OverflowError: # A number in the JSON body or cursor too large for SQLite
+                    status, result = HTTPStatus.BAD_REQUEST, {"error": "Numero troppo grande"}
+                except Exception as e:
+                    status, result = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+                # HTTP/1.0 closes by default, HTTP/1.1 keeps the connection open
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+                writer.write(_response(status, result, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            writer.write(_response(e.status, {"error": str(e)}, False))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown() # Lets a write still queued finish
+        database.close_all_connections()
+
+async def _read_request(reader):
+    """(method, target, version, headers, body) of the next request, or None when the client is done."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Richiesta non valida")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = _int(headers.get("content-length", 0), "Content-Length")
+    if length < 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Content-Length non valido: {length}")
+    if length > MAX_BODY:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Richiesta troppo grande")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, version.upper(), headers, body
+
+def _response(status, result, keep_alive):
+    body = b"" if result is None else json.dumps(result, ensure_ascii=False).encode("utf-8")
+    head = [
+        f"HTTP/1.1 {status.value} {status.phrase}",
+        "Content-Type: application/json; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        "Access-Control-Allow-Origin: *",
+        "Access-Control-Allow-Methods: GET, POST, PUT, DELETE, OPTIONS",
+        "Access-Control-Allow-Headers: Content-Type",
+    ]
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+async def serve(host=HOST, port=PORT, readers=READERS, ready=None):
+    """Runs the server until cancelled; ready(port) is called once it is listening."""
+    database.create_table()
+    library = LibraryServer(readers)
+    server = await asyncio.start_server(library.handle_connection, host, port)
+    try:
+        if ready:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+    finally:
+        library.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HTTP/JSON locale per library.db")
+    parser.add_argument("--host", default=HOST, help=f"indirizzo (default {HOST}: solo questo PC; 0.0.0.0: tutta la rete)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--readers", type=int, default=READERS, help="thread per le letture")
+    parser.add_argument("--db", help="file del database (default: library.db)")
+    args = parser.parse_args()
+    if args.db:
+        database.configure(db_name=args.db)
+    ready = lambda port: print(f"In ascolto su http://{args.host}:{port}", flush=True)
+    try:
+        asyncio.run(serve(args.host, args.port, args.readers, ready))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Load test for server.py: several clients send a mix of searches, page loads, facet
+counts and (optionally) edits for a while, then requests/s and latencies per kind of
+request are printed as JSON.
+
+    python server_load_test.py                      # starts its own server on a synthetic catalog
+    python server_load_test.py --clients 16 --write-share 0.1
+    python server_load_test.py --url http://127.0.0.1:8765    # an instance already running
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmark import generate_catalog, GENRES, TITLE_WORDS, SEED
+
+def start_server(workdir, size, readers):
+    """Builds a catalog of size books in workdir and starts server.py on a free port."""
+    import database
+    db_name = os.path.join(workdir, "server.db")
+    database.configure(db_name=db_name)
+    database.create_table()
+    books = list(generate_catalog(size, SEED))
+    for i in range(0, len(books), 5000):
+        database.add_books(books[i:i + 5000])
+    database.close_all_connections()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    process = subprocess.Popen([sys.executable, script, "--db", db_name, "--port", "0", "--readers", str(readers)],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    match = re.search(r"http://\S+", line)
+    if match is None:
+        process.kill()
+        raise RuntimeError(f"Il server non è partito: {line!r}")
+    return process, match.group(0)
+
+def _next_request(rng, ids, write_share):
+    """(kind, method, path, body) of a random request."""
+    if rng.random() < write_share:
+        return "update", "PUT", f"/books/{rng.choice(ids)}", {"location": f"{rng.choice('ABCDEFGH')}{rng.randint(1, 12)}"}
+    choice = rng.random()
+    if choice < 0.45:
+        query = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 2)))
+        return "search", "GET", "/books?" + urllib.parse.urlencode({"q": query}), None
+    if choice < 0.7:
+        return "browse", "GET", "/books?" + urllib.parse.urlencode({"filter": f"genre:{rng.choice(GENRES)}"}), None
+    if choice < 0.85:
+        return "facets", "GET", "/facets?limit=30", None
+    return "get", "GET", f"/books/{rng.choice(ids)}", None
+
+def client(number, url, ids, seconds, write_share, results):
+    rng = random.Random(number)
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    timings = {}
+    errors = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        kind, method, path, body = _next_request(rng, ids, write_share)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=json.dumps(body) if body else None,
+                         headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            conn.close() # Reconnects on the next request
+            ok = False
+        if ok:
+            timings.setdefault(kind, []).append((time.perf_counter() - start) * 1000)
+        else:
+            errors += 1
+    conn.close()
+    results.append((timings, errors))
+
+def summarize(timings, seconds):
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "requests_per_sec": round(len(timings) / seconds, 1),
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prova di carico di server.py")
+    parser.add_argument("--url", help="server già avviato (default: ne avvia uno su un catalogo sintetico)")
+    parser.add_argument("--clients", type=int, default=8, help="client contemporanei")
+    parser.add_argument("--seconds", type=float, default=10, help="durata della prova")
+    parser.add_argument("--write-share", type=float, default=0.05, help="quota di richieste che modificano un libro")
+    parser.add_argument("--size", type=int, default=20000, help="libri del catalogo sintetico")
+    parser.add_argument("--readers", type=int, default=4, help="thread di lettura del server avviato")
+    parser.add_argument("--output", help="salva i risultati JSON in questo file (default: stdout)")
+    args = parser.parse_args()
+
+    workdir = process = None
+    url = args.url
+    try:
+        if url is None:
+            workdir = tempfile.mkdtemp(prefix="library_server_")
+            process, url = start_server(workdir, args.size, args.readers)
+        parts = urllib.parse.urlsplit(url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        conn.request("GET", "/books?limit=200")
+        ids = [book["id"] for book in json.loads(conn.getresponse().read())["books"]]
+        conn.close()
+        if not ids:
+            raise RuntimeError("Il catalogo è vuoto")
+
+        print(f"{args.clients} client per {args.seconds}s su {url}", file=sys.stderr)
+        results = []
+        threads = [threading.Thread(target=client, args=(n, url, ids, args.seconds, args.write_share, results))
+                   for n in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    by_kind = {}
+    for timings, _ in results:
+        for kind, values in timings.items():
+            by_kind.setdefault(kind, []).extend(values)
+    everything = [t for values in by_kind.values() for t in values]
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "url": args.url or "locale",
+                 "clients": args.clients, "seconds": args.seconds, "write_share": args.write_share},
+        "total": dict(summarize(everything, args.seconds) if everything else {},
+                      errors=sum(errors for _, errors in results)),
+        "requests": {kind: summarize(values, args.seconds) for kind, values in sorted(by_kind.items())},
+    }
+    print(f"  {report['total'].get('requests_per_sec', 0):.1f} richieste/s, {report['total']['errors']} errori",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()